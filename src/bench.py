@@ -0,0 +1,214 @@
+"""Benchmarks for readmap on simulated genomes and reads.
+
+    python3 src/bench.py [--sizes n ...] [--chromosomes c ...]
+                         [--read-lengths m ...] [--edits d ...]
+                         [--json file] [--csv file]
+
+Every combination of genome size, chromosome count, read length and
+edit limit is measured: preprocessing time and peak memory, index size
+and load time, and the time, reads per second and peak memory of
+mapping. Preprocessing and mapping each run in a child process, so
+their peak RSS is their own. The genomes and reads are generated from
+--seed, so runs on different commits can be compared row by row.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import readmap
+
+def simulate_genome(rng: random.Random, size: int, chromosomes: int) -> list:
+    """A random genome of size symbols split evenly into chromosomes.
+
+    >>> genome = simulate_genome(random.Random(0), 10, 3)
+    >>> [(name, len(seq)) for name, seq in genome]
+    [('chr0', 3), ('chr1', 3), ('chr2', 4)]
+    """
+    bounds = [size * i // chromosomes for i in range(chromosomes + 1)]
+    return [(f'chr{i}', ''.join(rng.choices('acgt', k=hi - lo)))
+            for i, (lo, hi) in enumerate(zip(bounds, bounds[1:]))]
+
+def mutate(rng: random.Random, seq: str, edits: int) -> str:
+    """Apply edits random substitutions, insertions and deletions."""
+    seq = list(seq)
+    for _ in range(edits):
+        op, i = rng.choice('SID'), rng.randrange(len(seq))
+        if op == 'S':
+            seq[i] = rng.choice('acgt')
+        elif op == 'I':
+            seq.insert(i, rng.choice('acgt'))
+        elif len(seq) > 1:
+            del seq[i]
+    return ''.join(seq)
+
+def simulate_reads(rng: random.Random, genome: list, count: int, length: int, edit_limit: int) -> list:
+    """count reads of the given length sampled from genome, each with
+    between 0 and edit_limit edits.
+
+    >>> genome = simulate_genome(random.Random(0), 100, 2)
+    >>> reads = simulate_reads(random.Random(1), genome, 3, 10, 0)
+    >>> [name for name, read in reads], all(read in genome[0][1] + genome[1][1] for name, read in reads)
+    (['read0', 'read1', 'read2'], True)
+    """
+    chromosomes = [seq for name, seq in genome if len(seq) >= length]
+    reads = []
+    for i in range(count):
+        seq = rng.choice(chromosomes)
+        pos = rng.randrange(len(seq) - length + 1)
+        reads.append((f'read{i}', mutate(rng, seq[pos:pos+length], rng.randint(0, edit_limit))))
+    return reads
+
+def write_fasta(records: list, path: str):
+    with open(path, 'w') as f:
+        for name, seq in records:
+            f.write(f'>{name}\n{seq}\n')
+
+def write_fastq(reads: list, path: str):
+    with open(path, 'w') as f:
+        for name, read in reads:
+            f.write(f'@{name}\n{read}\n')
+
+def run_child(*args) -> tuple:
+    """Run this script with --child args, and return the JSON it prints
+    and its peak RSS in MB."""
+    proc = subprocess.Popen([sys.executable, __file__, '--child', *map(str, args)],
+                            stdout=subprocess.PIPE, text=True)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f'bench child {args} failed with exit code {proc.returncode}')
+    return json.loads(output), usage.ru_maxrss / 1024
+
+def child(task: str, *args):
+    """The measurements done in a child process, printed as JSON."""
+    if task == 'preprocess':
+        genome, = args
+        t0 = time.perf_counter()
+        with open(genome) as f:
+            readmap.process_file(readmap.fasta_func(f), readmap.index_path(genome))
+        result = {'seconds': time.perf_counter() - t0}
+    else:
+        genome, reads, edit_limit, engine, threads = args
+        prepro_file = readmap.index_path(genome)
+        t0 = time.perf_counter()
+        readmap.load_index(prepro_file)
+        t1 = time.perf_counter()
+        with open(reads) as f:
+            sams = readmap.approximate_matching(prepro_file, readmap.fastq_func(f), int(edit_limit), int(threads), engine)
+            hits = sum(sam.count('\n') + 1 for sam in sams)
+        result = {'load_seconds': t1 - t0, 'map_seconds': time.perf_counter() - t1, 'hits': hits}
+    print(json.dumps(result))
+
+def git_commit() -> str:
+    """The commit of the working tree, or '' outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def bench(args, workdir: str):
+    """Yield one result row per configuration in args."""
+    commit = git_commit()
+    for size in args.sizes:
+        for chromosomes in args.chromosomes:
+            rng = random.Random(f'{args.seed}-{size}-{chromosomes}')
+            genome = simulate_genome(rng, size, chromosomes)
+            longest = max(len(seq) for name, seq in genome)
+            lengths = [length for length in args.read_lengths if length <= longest]
+            for length in sorted(set(args.read_lengths) - set(lengths)):
+                print(f"n={size} chromosomes={chromosomes} m={length}: skipped, "
+                      f"longer than every chromosome ({longest} bp)", file=sys.stderr, flush=True)
+            if not lengths:
+                continue
+            fasta = os.path.join(workdir, f'genome-{size}-{chromosomes}.fa')
+            write_fasta(genome, fasta)
+            pre, pre_rss = run_child('preprocess', fasta)
+            index_mb = os.path.getsize(readmap.index_path(fasta)) / (1 << 20)
+
+            for length in lengths:
+                for edit_limit in args.edits:
+                    reads = simulate_reads(rng, genome, args.reads, length, edit_limit)
+                    fastq = os.path.join(workdir, f'reads-{size}-{chromosomes}-{length}-{edit_limit}.fq')
+                    write_fastq(reads, fastq)
+                    mapped, map_rss = run_child('map', fasta, fastq, edit_limit, args.engine, args.threads)
+                    yield {
+                        'commit': commit,
+                        'genome_size': size,
+                        'chromosomes': chromosomes,
+                        'read_length': length,
+                        'edits': edit_limit,
+                        'reads': len(reads),
+                        'engine': args.engine,
+                        'threads': args.threads,
+                        'preprocess_s': round(pre['seconds'], 4),
+                        'preprocess_rss_mb': round(pre_rss, 1),
+                        'index_mb': round(index_mb, 2),
+                        'load_s': round(mapped['load_seconds'], 4),
+                        'map_s': round(mapped['map_seconds'], 4),
+                        'reads_per_s': round(len(reads) / mapped['map_seconds'], 1),
+                        'map_rss_mb': round(map_rss, 1),
+                        'hits': mapped['hits'],
+                    }
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark readmap on simulated data")
+    argparser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], metavar="n",
+                           help="genome sizes (default: 10000 100000).")
+    argparser.add_argument("--chromosomes", type=int, nargs="+", default=[1, 10], metavar="c",
+                           help="chromosome counts (default: 1 10).")
+    argparser.add_argument("--read-lengths", type=int, nargs="+", default=[50, 100], metavar="m",
+                           help="read lengths (default: 50 100).")
+    argparser.add_argument("--edits", type=int, nargs="+", default=[0, 1, 2, 3], metavar="d",
+                           help="edit limits (default: 0 1 2 3).")
+    argparser.add_argument("--reads", type=int, default=200, metavar="integer",
+                           help="reads per configuration (default: 200).")
+    argparser.add_argument("--engine", choices=readmap.ENGINES, default="backtrack",
+                           help="search engine to benchmark.")
+    argparser.add_argument("-t", "--threads", type=int, default=1, metavar="integer",
+                           help="worker processes used for mapping.")
+    argparser.add_argument("--seed", default="0", help="seed for the simulated data.")
+    argparser.add_argument("--json", metavar="file", help="write the results as JSON here.")
+    argparser.add_argument("--csv", metavar="file", help="write the results as CSV here.")
+    argparser.add_argument("--workdir", metavar="dir",
+                           help="keep the simulated files and indexes here (default: a temporary directory).")
+    argparser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        rows = []
+        for row in bench(args, workdir):
+            print(f"n={row['genome_size']} chromosomes={row['chromosomes']} m={row['read_length']} "
+                  f"d={row['edits']}: preprocess {row['preprocess_s']:.2f}s, "
+                  f"{row['reads_per_s']:.0f} reads/s, {row['map_rss_mb']:.0f} MB",
+                  file=sys.stderr, flush=True)
+            rows.append(row)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    if args.csv and rows:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    if not args.json and not args.csv:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
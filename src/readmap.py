@@ -1,160 +1,1479 @@
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import dbm
+import fcntl
+import gzip
+import hashlib
+import io
+import os
+import queue
+import signal
+import socket
+import socketserver
 import sys
-import ast
+import itertools
+import json
+import mmap
+import multiprocessing
 import re
+import struct
+import threading
+import time
+import zlib
+from array import array
 
-def suffixArray(x: str) -> list:
-    """Given x return suffix array SA(x). 
-       We use Python's sorted function here 
-       for simplycity, but we can do better.
+try:
+    import numpy as np
+    np.bitwise_count # NumPy >= 2.0
+except (ImportError, AttributeError): # reads are then searched one at a time
+    np = None
+
+def _sais(s: list, K: int) -> list:
+    """Suffix array of s by induced sorting (SA-IS), in O(n) time.
 
     Args:
-        x (str): input string.
-    """  
-    satups = sorted([(x[i:], i) for i in range(len(x))])
-    
-    return list(map(lambda t: t[1], satups))
+        s (list[int]): symbols in range(K), ending in a unique 0 sentinel.
+        K (int): alphabet size.
 
-def count_to_bucket(count: str) -> dict:
-    '''
-    >>> count_to_bucket("$iiiimppss")
-    {'$': 0, 'i': 1, 'm': 5, 'p': 6, 's': 8}
-    '''
-    C = {}
-    for i,c in enumerate(count):
-        if c in C:
+    >>> _sais([2, 1, 3, 1, 3, 1, 0], 4)
+    [6, 5, 3, 1, 0, 4, 2]
+    """
+    n = len(s)
+    if n == 1:
+        return [0]
+
+    # Classify suffixes as S-type (True) or L-type (False).
+    t = [False] * n
+    t[n-1] = True
+    for i in range(n-2, -1, -1):
+        t[i] = s[i] < s[i+1] or (s[i] == s[i+1] and t[i+1])
+    lms = [i for i in range(1, n) if t[i] and not t[i-1]]
+
+    sizes = [0] * K
+    for c in s:
+        sizes[c] += 1
+
+    def buckets(ends: bool) -> list:
+        b, total = [0] * K, 0
+        for c in range(K):
+            total += sizes[c]
+            b[c] = total if ends else total - sizes[c]
+        return b
+
+    def induce(lms_order: list) -> list:
+        sa = [-1] * n
+        b = buckets(True)
+        for i in reversed(lms_order):
+            b[s[i]] -= 1
+            sa[b[s[i]]] = i
+        b = buckets(False)
+        for k in range(n):
+            j = sa[k] - 1
+            if j >= 0 and not t[j]:
+                sa[b[s[j]]] = j
+                b[s[j]] += 1
+        b = buckets(True)
+        for k in range(n-1, -1, -1):
+            j = sa[k] - 1
+            if j >= 0 and t[j]:
+                b[s[j]] -= 1
+                sa[b[s[j]]] = j
+        return sa
+
+    # Sort the LMS substrings and give equal substrings equal names.
+    sa = induce(lms)
+    lms_end = dict(zip(lms, lms[1:] + [n-1]))
+    names = {}
+    name, prev = -1, None
+    for i in sa:
+        if i not in lms_end:
             continue
-        else:
-            C[c] = i
+        end = lms_end[i]
+        if prev is None or end - i != lms_end[prev] - prev \
+                or s[i:end+1] != s[prev:lms_end[prev]+1]:
+            name += 1
+        names[i] = name
+        prev = i
+
+    # Recurse on the reduced string if the names are not unique.
+    reduced = [names[i] for i in lms]
+    if name + 1 == len(reduced):
+        reduced_sa = [0] * len(reduced)
+        for k, c in enumerate(reduced):
+            reduced_sa[c] = k
+    else:
+        reduced_sa = _sais(reduced, name + 1)
+
+    return induce([lms[k] for k in reduced_sa])
+
+def pack_bits(flags: str) -> tuple:
+    """Pack a string of '0' and '1' into a bit vector with rank counts.
+
+    Returns:
+        tuple: The 64-bit words, where bit i of word w is flags[64*w + i],
+        and the number of set bits before each word. There is always a
+        word past the last flag, so ranks up to len(flags) can be looked up.
+
+    >>> words, counts = pack_bits('0110' * 20)
+    >>> list(words), list(counts)
+    ([7378697629483820646, 26214], [0, 32])
+    """
+    words, counts = array('Q'), array('I')
+    n = 0
+    for i in range(0, len(flags) + 1, 64):
+        word = int(flags[i:i+64][::-1] or '0', 2)
+        words.append(word)
+        counts.append(n)
+        n += word.bit_count()
+    return words, counts
+
+# Sequences are indexed over a fixed alphabet: a, c, g and t, in either
+# case, are the codes 0 to 3, and every other symbol is code 4. The '$'
+# separators are code 4 as well, and rarer symbols such as N are masked
+# or kept out of the index altogether (see join_sequences), so the
+# search only ever branches over range(SIGMA).
+ALPHABET = 'acgt'
+SIGMA = len(ALPHABET)
+_CODES = bytes(ALPHABET.index(chr(b).lower()) if chr(b).lower() in ALPHABET else SIGMA
+               for b in range(256))
+
+def encode(seq: str) -> bytes:
+    """The symbol codes of seq.
+
+    >>> list(encode('acGTn$'))
+    [0, 1, 2, 3, 4, 4]
+    """
+    return seq.encode('latin-1', 'replace').translate(_CODES)
+
+# Codes are packed 32 to a 64-bit word, two bits each, with code c in
+# slot i of word w standing for position 32*w + i. _REPEAT[c] has c in
+# every slot, and _BELOW[r] the low bit of every slot before slot r.
+_LOW = 0x5555555555555555
+_REPEAT = [c * _LOW for c in range(SIGMA)]
+_BELOW = [_LOW & ((1 << 2 * r) - 1) for r in range(32)]
+if np is not None:
+    _REPEAT_ARRAY = np.array(_REPEAT, dtype=np.uint64)
+    _BELOW_ARRAY = np.array(_BELOW, dtype=np.uint64)
+_DIGITS = bytes.maketrans(bytes(range(SIGMA + 1)), b'01230')
+
+def pack_codes(codes: bytes) -> array:
+    """Pack symbol codes into 64-bit words of 32 two-bit slots. Code 4
+    is stored as 0. There is always a word holding position len(codes),
+    so ranks up to len(codes) can be looked up.
+
+    >>> list(pack_codes(bytes([0, 1, 2, 3, 4, 3]))), len(pack_codes(bytes(32)))
+    ([3300], 2)
+    """
+    digits = codes.translate(_DIGITS)
+    return array('Q', (int(digits[i:i+32][::-1] or b'0', 4) for i in range(0, len(codes) + 1, 32)))
+
+def unpack_codes(words, begin: int, end: int) -> bytes:
+    """The codes from begin to end of the packed words.
+
+    >>> list(unpack_codes(pack_codes(encode('acgtacgtta' * 4)), 28, 34))
+    [3, 0, 0, 1, 2, 3]
+    """
+    codes = bytearray()
+    for w in range(begin >> 5, (end + 31) >> 5):
+        word = words[w]
+        codes.extend(word >> 2 * i & 3 for i in range(32))
+    first = begin & ~31
+    return bytes(codes[begin - first:end - first])
 
-    return C
+class OccTable:
+    """The O table of a BWT as a rank structure.
 
-def calc_O(bwt: str, C: dict) -> dict:
+    The BWT is packed two bits per symbol (see pack_codes), and the
+    occurrences of each code before every word are kept alongside.
+    rank(c, i) is then the count stored for i's word plus a popcount of
+    the slots below i that hold c. The few '$' in the BWT share code 0
+    with 'a' in the packed words, so the rows holding them are kept too
+    and taken off the in-word count of 'a'.
+
+    Args:
+        words (array): the packed BWT.
+        counts (array): occurrences of code c before word w at 4*w + c.
+        dollars (array): the rows where the BWT has a '$', in order.
+    """
+
+    def __init__(self, words, counts, dollars):
+        self.words = words
+        self.counts = counts
+        self.dollars = dollars
+        self.dollar_slots = {}
+        for i in dollars:
+            self.dollar_slots[i >> 5] = self.dollar_slots.get(i >> 5, 0) | 1 << 2 * (i & 31)
+
+    def rank(self, c: int, i: int) -> int:
+        """Number of occurrences of code c in bwt[:i]."""
+        w = i >> 5
+        x = self.words[w] ^ _REPEAT[c]
+        n = self.counts[w << 2 | c] + (~(x | x >> 1) & _BELOW[i & 31]).bit_count()
+        if c == 0 and w in self.dollar_slots:
+            n -= (self.dollar_slots[w] & _BELOW[i & 31]).bit_count()
+        return n
+
+    def symbol(self, i: int) -> int:
+        """The code of bwt[i], which is 0 for a '$'."""
+        return self.words[i >> 5] >> 2 * (i & 31) & 3
+
+def calc_O(bwt: bytes) -> OccTable:
     '''
-    >>> calc_O('aaba$', { '$' : 0, 'a' : 1, 'b' : 4})
-    {'$': [0, 0, 0, 0, 0, 1], 'a': [0, 1, 2, 2, 3, 3], 'b': [0, 0, 0, 1, 1, 1]}
+    >>> O = calc_O(encode('aaca$'))
+    >>> [[O.rank(c, i) for i in range(6)] for c in range(2)]
+    [[0, 1, 2, 2, 3, 3], [0, 0, 0, 1, 1, 1]]
+    >>> O = calc_O(encode('ag' * 64))
+    >>> O.rank(0, 64), O.rank(2, 127), O.rank(2, 128), O.rank(3, 128)
+    (32, 63, 64, 0)
+    >>> O.symbol(0), O.symbol(127)
+    (0, 2)
     '''
-    O = C.copy()
-    for k in O.keys():
-        O[k] = [0]
-    
-    for char in bwt:
-        for k in O.keys():
-            if k == char:
-                O[k].append(O[k][-1]+1)
+    words = pack_codes(bwt)
+    counts = array('I')
+    total = [0] * SIGMA
+    for i in range(0, 32 * len(words), 32):
+        counts.extend(total)
+        chunk = bwt[i:i+32]
+        for c in range(SIGMA):
+            total[c] += chunk.count(c)
+    dollars = array('I')
+    i = bwt.find(SIGMA)
+    while i >= 0:
+        dollars.append(i)
+        i = bwt.find(SIGMA, i + 1)
+    return OccTable(words, counts, dollars)
+
+class SampledSA:
+    """A suffix array that only keeps the entries divisible by step.
+
+    Looking up any other row walks the LF mapping, i = C[c] + O(c, i)
+    for c = bwt[i], which moves one position back in the text, until it
+    reaches a sampled row. Lookups take at most step - 1 LF steps.
+
+    Args:
+        step (int): the sampling rate.
+        n (int): the length of the full suffix array.
+        samples (array): the sampled entries, in suffix array order.
+        bits (array): bit vector words marking the sampled rows.
+        counts (array): number of sampled rows before each word.
+        C (list): the C table of the text.
+        O (OccTable): the O table of the text.
+    """
+
+    def __init__(self, step: int, n: int, samples, bits, counts, C: list, O: OccTable):
+        self.step = step
+        self.n = n
+        self.samples = samples
+        self.bits = bits
+        self.counts = counts
+        self.C = C
+        self.O = O
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> int:
+        bits, C, O = self.bits, self.C, self.O
+        steps = 0
+        while not bits[i >> 6] >> (i & 63) & 1:
+            c = O.symbol(i)
+            i = C[c] + O.rank(c, i)
+            steps += 1
+        w = i >> 6
+        return self.samples[self.counts[w] + (bits[w] & ((1 << (i & 63)) - 1)).bit_count()] + steps
+
+def sample_sa(sa: array, step: int, starts: tuple = ()) -> tuple:
+    """Keep the suffix array entries divisible by step, and the ones
+    in starts. Sampling the start of every sequence in a concatenated
+    text means LF walks never have to cross a separator.
+
+    Returns:
+        tuple: The kept entries and the packed bit vector (see pack_bits)
+        marking the rows they came from.
+
+    >>> sa, C, RO, O = bwt_C_O('gattacaatc')
+    >>> samples, bits, counts = sample_sa(sa, 3)
+    >>> list(samples), bin(bits[0])
+    ([6, 9, 0, 3], '0b110100010')
+
+    The other entries are found again by LF walking:
+
+    >>> ssa = SampledSA(3, len(sa), samples, bits, counts, C, O)
+    >>> [ssa[i] for i in range(len(ssa))] == list(sa)
+    True
+    """
+    starts = set(starts)
+    keep = [i % step == 0 or i in starts for i in sa]
+    samples = array('I', (i for i, k in zip(sa, keep) if k))
+    bits, counts = pack_bits(''.join('1' if k else '0' for k in keep))
+    return samples, bits, counts
+
+class KmerTable:
+    """The suffix array intervals of every string of length at most k
+    over the codes range(SIGMA).
+
+    The strings of length d are numbered in order, each code being a
+    base SIGMA digit with the first code most significant, and come
+    after all shorter strings. Prepending a code to a string of length
+    d < k is then a constant-time change of its number, so a backward
+    search can replace its first k LF steps by lookups.
+
+    Args:
+        k (int): the longest string length in the table.
+        L (array): the start of each string's interval.
+        R (array): the end of each string's interval.
+    """
+
+    def __init__(self, k: int, L, R):
+        self.k = k
+        self.L = L
+        self.R = R
+        self.power = [SIGMA ** d for d in range(k + 1)]
+        self.offset = list(itertools.accumulate(self.power, initial=0))
+
+    def extend(self, c: int, i: int, d: int) -> int:
+        """Number of c + t, for the string t of length d < k numbered i."""
+        return self.offset[d+1] + c * self.power[d] + i - self.offset[d]
+
+    def index(self, s: bytes) -> int:
+        """Number of the codes s, with len(s) <= k, or -1 if s has a
+        code outside range(SIGMA)."""
+        i = 0
+        for c in s:
+            if c >= SIGMA:
+                return -1
+            i = i * SIGMA + c
+        return self.offset[len(s)] + i
+
+def build_kmer_table(C: list, O: OccTable, n: int, k: int) -> KmerTable:
+    """Compute the KmerTable of a text from its C and O tables, each
+    string's interval by one LF step from the string without its first
+    code.
+
+    >>> sa, C, RO, O = bwt_C_O('gattacaatc')
+    >>> kmers = build_kmer_table(C, O, len(sa), 2)
+    >>> i = kmers.index(encode('at'))
+    >>> sorted(sa[j] for j in range(kmers.L[i], kmers.R[i]))
+    [1, 7]
+    >>> i = kmers.extend(2, kmers.index(encode('a')), 1)
+    >>> sorted(sa[j] for j in range(kmers.L[i], kmers.R[i]))
+    [0]
+    """
+    L, R = array('I', [0]), array('I', [n])
+    start = 0 # first string of the previous length
+    for d in range(k):
+        end = len(L)
+        for c in range(SIGMA):
+            for i in range(start, end):
+                l, r = L[i], R[i]
+                if l < r:
+                    l, r = C[c] + O.rank(c, l), C[c] + O.rank(c, r)
+                L.append(l)
+                R.append(r)
+        start = end
+    return KmerTable(k, L, R)
+
+# The longest k accepted for a KmerTable: its two arrays of 4-byte
+# interval bounds take 8 * (4 ** (k + 1) - 1) / 3 bytes, about 180 MB
+# for k = 12.
+MAX_KMER_LENGTH = 12
+
+def kmer_length(n: int, sigma: int, limit: int = 10) -> int:
+    """The default k for a KmerTable: the largest k <= limit such that
+    there are no more strings of length k than symbols in the text.
+
+    >>> kmer_length(1000, 4), kmer_length(10 ** 9, 4), kmer_length(10, 1)
+    (4, 10, 10)
+    """
+    k = 0
+    while k < limit and sigma ** (k + 1) <= n:
+        k += 1
+    return k
+
+# Symbols outside the alphabet are masked: the text holds an a in their
+# place. Runs of them longer than 2 * MASKED_EDGE split their sequence,
+# keeping the MASKED_EDGE symbols at either end, as no alignment with at
+# most MASKED_EDGE edits reaches further into them.
+MASKED_EDGE = 8
+
+def join_sequences(records) -> tuple:
+    """Concatenate sequences into one text, separated by '$'.
+
+    Symbols other than a, c, g and t, such as N or IUPAC codes, are
+    kept aside in the runs of rare symbols, and masked in the text (see
+    MASKED_EDGE) so that alignments can cross them with a mismatch per
+    symbol, which MaskedRuns checks when a hit is reported. The middle
+    of longer runs is left out: it splits its sequence into fragments,
+    and alignments cannot cross it, as they cannot cross a '$'.
+
+    Args:
+        records: (name, sequence) pairs, as from fasta_func.
+
+    Returns:
+        tuple: The text, the [name, offset] of each fragment in its
+        sequence, the offset of each fragment in the text followed by
+        len(text) + 1, the [name, length] of each sequence, and the
+        runs of rare symbols as [sequence number, offset, symbol,
+        length, offset in the text or None if left out] lists.
+
+    >>> text, names, starts, seqs, rare = join_sequences([('chr1', 'acgt'), ('chr2', 'gg' + 'N' * 20 + 'cRa')])
+    >>> text, names, starts
+    ('acgt$ggaaaaaaaa$aaaaaaaacaa', [['chr1', 0], ['chr2', 0], ['chr2', 14]], array('I', [0, 5, 16, 28]))
+    >>> seqs, rare
+    ([['chr1', 4], ['chr2', 25]], [[1, 2, 'N', 8, 7], [1, 10, 'N', 4, None], [1, 14, 'N', 8, 16], [1, 23, 'R', 1, 25]])
+    """
+    names, fragments, seqs, rare = [], [], [], []
+    starts = array('I', [0])
+    split = re.compile(f'[^acgtACGT]{{{2 * MASKED_EDGE + 1},}}')
+    for name, seq in records:
+        spans, begin = [], 0
+        for m in itertools.chain(split.finditer(seq), [None]):
+            end = len(seq) if m is None else m.start() + MASKED_EDGE if m.start() > 0 else 0
+            if begin < end:
+                names.append([name, begin])
+                fragments.append(re.sub('[^acgtACGT]', 'a', seq[begin:end]))
+                spans.append((begin, end, starts[-1]))
+                starts.append(starts[-1] + end - begin + 1)
+            if m is not None:
+                begin = m.end() - MASKED_EDGE if m.end() < len(seq) else len(seq)
+        spans.append((len(seq), len(seq), None))
+        k = 0
+        for m in re.finditer(r'([^acgtACGT])\1*', seq):
+            offset = m.start()
+            while offset < m.end():
+                while spans[k][1] <= offset:
+                    k += 1
+                begin, end, start = spans[k]
+                if begin <= offset: # masked
+                    length, pos = min(m.end(), end) - offset, start + offset - begin
+                else:
+                    length, pos = min(m.end(), begin) - offset, None
+                rare.append([len(seqs), offset, m[1], length, pos])
+                offset += length
+        seqs.append([name, len(seq)])
+    return '$'.join(fragments), names, starts, seqs, rare
+
+class MaskedRuns:
+    """The text positions of a section's masked symbols (see
+    join_sequences), to check the edits of hits that cover them.
+
+    The search sees a masked symbol as an a, so it finds every
+    alignment that has at most edit_limit edits when masked symbols
+    mismatch every base, and maybe more. allows tells them apart.
+
+    Args:
+        rare (list): the runs of rare symbols, as from join_sequences.
+        text (array): the packed text, as from pack_codes.
+
+    >>> text, names, starts, seqs, rare = join_sequences([('chr1', 'acgNNgta')])
+    >>> masked = MaskedRuns(rare, pack_codes(encode(text)))
+    >>> list(masked.positions)
+    [3, 4]
+    >>> [masked.allows(pos, 7, '7M', 'cgaagta', 2) for pos in (0, 1)]
+    [False, True]
+    >>> masked.allows(1, 5, '5M', 'cgtgt', 2), masked.allows(1, 7, '2M2D3M', 'cggta', 2)
+    (False, True)
+    """
+
+    def __init__(self, rare: list, text):
+        self.positions = array('I', (pos + i for s, offset, symbol, length, pos in rare
+                                     if pos is not None for i in range(length)))
+        self.text = text
+
+    def __bool__(self) -> bool:
+        return len(self.positions) > 0
+
+    def allows(self, pos: int, length: int, cigar: str, read: str, edit_limit: int) -> bool:
+        """Whether the hit of read at text position pos, covering length
+        text symbols, has at most edit_limit edits when masked symbols
+        are counted as mismatches."""
+        lo = bisect.bisect_left(self.positions, pos)
+        hi = bisect.bisect_left(self.positions, pos + length)
+        if lo == hi:
+            return True
+        masked = {p - pos for p in self.positions[lo:hi]}
+        window = unpack_codes(self.text, pos, pos + length)
+        codes = encode(read)
+        edits, i, j = 0, 0, 0
+        for count, op in re.findall(r'(\d+)([MID])', cigar):
+            count = int(count)
+            if op == 'M':
+                edits += sum(codes[i+k] != window[j+k] or j + k in masked for k in range(count))
+                i, j = i + count, j + count
+            elif op == 'I':
+                edits, i = edits + count, i + count
             else:
-                O[k].append(O[k][-1])
-    
-    return O  
-   
-def bwt_C_O(x: str) -> tuple():
-    """Calculates SA, C and O.
+                edits, j = edits + count, j + count
+        return edits <= edit_limit
+
+def to_chromosome(names: list, starts: array, pos: int, length: int):
+    """Translate a hit in the concatenated text to its sequence.
 
     Args:
-        x (str): input string we want to find pattern in.
+        names (list): the [name, offset] of each fragment.
+        starts (array): the fragment offsets, as from join_sequences.
+        pos (int): offset of the hit in the text.
+        length (int): number of text symbols the hit covers.
 
     Returns:
-        SA, C and O
-    """    
+        tuple: The sequence name and the offset of the hit in it, or
+        None if the hit runs past the end of the fragment.
 
-    last_idx = len(x) # last_idx
-    rev_x = ''.join(reversed(x))+'$'
-    Rsa = suffixArray(rev_x)
-    Rbwt = ''.join([rev_x[(i + last_idx)%len(rev_x)] for i in Rsa])
+    >>> names, starts = [['chr1', 0], ['chr1', 7]], array('I', [0, 5, 8])
+    >>> to_chromosome(names, starts, 5, 2), to_chromosome(names, starts, 2, 3)
+    (('chr1', 7), None)
+    """
+    k = bisect.bisect_right(starts, pos) - 1
+    if k + 1 == len(starts) or pos + length >= starts[k+1]: # or no fragments
+        return None
+    name, offset = names[k]
+    return name, offset + pos - starts[k]
 
-    x += '$'
-    sa = suffixArray(x) 
-    bwt = ''.join([x[(i + last_idx)%len(x)] for i in sa]) # Calculates bwt(x)
+# Ranks of the codes for sorting suffixes, with '$' before the bases
+# and 0 left for the sentinel.
+_SA_RANKS = bytes.maketrans(bytes(range(SIGMA + 1)), bytes([2, 3, 4, 5, 1]))
 
-    count = ''.join([x[i] for i in sa]) # Sort x
-    C = count_to_bucket(count) # dict with cumulative counts
-    
-    RO = calc_O(Rbwt, C)
-    O = calc_O(bwt, C) # dict (table) with offsets
-    return Rsa, sa, C, RO, O
+def bwt_C_O(x: str) -> tuple():
+    """Calculates SA, C and O for x and the O table of its reverse.
 
-def fasta_func(fastafile: str) -> dict:
-    """Function that can take file or list of strings
+    Args:
+        x (str): input string we want to find pattern in; symbols other
+            than a, c, g and t are separators like '$'.
 
     Returns:
-        dict: return dictionary with fasta sequence coupled with its sequence name
+        SA, C and the RO and O tables of x + '$'. C[c] is the number of
+        symbols smaller than code c, '$' included.
+
+    >>> sa, C, RO, O = bwt_C_O('gattaca')
+    >>> list(sa), C
+    ([7, 6, 4, 1, 5, 0, 3, 2], [1, 4, 5, 6])
+    >>> list(bwt_C_O('aaaa')[0]), list(bwt_C_O('')[0])
+    ([4, 3, 2, 1, 0], [0])
+
+    The suffix array is in the same order as sorting the suffixes
+    directly:
+
+    >>> import glob
+    >>> genomes = [seq for f in glob.glob('__TEST__/data/genome-*.fa')
+    ...            for name, seq in fasta_func(open(f))]
+    >>> all(list(bwt_C_O(seq)[0]) ==
+    ...     sorted(range(len(seq) + 1), key=lambda i: (seq + '$')[i:])
+    ...     for seq in genomes)
+    True
+    """
+    x = encode(x) + bytes([SIGMA])
+    s = list(x.translate(_SA_RANKS))
+    s.append(0) # sentinel
+    sa = array('I', _sais(s, SIGMA + 2)[1:])
+    bwt = bytes(x[i-1] for i in sa)
+
+    rx = x[-2::-1] + bytes([SIGMA])
+    s = list(rx.translate(_SA_RANKS))
+    s.append(0)
+    Rbwt = bytes(rx[i-1] for i in _sais(s, SIGMA + 2)[1:])
+
+    counts = [x.count(c) for c in range(SIGMA)]
+    C = list(itertools.accumulate(counts[:-1], initial=len(x) - sum(counts)))
+    RO = calc_O(Rbwt)
+    O = calc_O(bwt)
+    return sa, C, RO, O
+
+def fasta_func(fastafile: str):
+    """Function that can take file or list of strings and yields its
+    records one at a time.
+
+    Yields:
+        tuple: the name and sequence of each record, in file order.
+
+    >>> list(fasta_func(['>chr1', 'acg', 'tt', '>chr2', 'ga']))
+    [('chr1', 'acgtt'), ('chr2', 'ga')]
     """    
     sequence = []
-    name = ''
-    fasta_dict = {}
+    name = None
     for line in fastafile:
         if type(line) == list:
             line = line[0]
         if line.startswith('>'):
-            if name != '':
-                fasta_dict[name] = ''.join(sequence)
+            if name is not None:
+                yield name, ''.join(sequence)
                 sequence = []
             name = line[1:].strip()
         else:
             sequence.append(line.strip())
 
-    if name != '':
-        fasta_dict[name] = ''.join(sequence)
+    if name is not None:
+        yield name, ''.join(sequence)
 
-    return fasta_dict
+def fastq_func(fastqfile: str):
+    """Yield the reads of a FASTQ file one at a time.
 
-def fastq_func(fastqfile: str) -> dict: 
-    
+    Both Simple-FASTQ, with only name and sequence lines, and full
+    FASTQ with '+' and quality lines are accepted. Quality lines are
+    skipped by length, since they may start with '@' themselves.
+
+    Yields:
+        tuple: the name and sequence of each read, in file order.
+
+    >>> list(fastq_func(['@r1', 'acgt', '@r2', 'gg']))
+    [('r1', 'acgt'), ('r2', 'gg')]
+    >>> list(fastq_func(['@r1', 'acgt', '+', '@III', '@r1', 'ga', '+r1', 'II']))
+    [('r1', 'acgt'), ('r1', 'ga')]
+    """
     read = []
-    name = ''
-    fastq_dict = {}
+    name = None
+    quality = 0 # quality symbols left to skip
     for line in fastqfile:
-        if line.startswith('@'):
-            if name != '':
-                fastq_dict[name] = ''.join(read)
+        line = line.strip()
+        if quality > 0:
+            quality -= len(line)
+        elif line.startswith('@'):
+            if name is not None:
+                yield name, ''.join(read)
                 read = []
-            name = line[1:].strip()
-        else:
-            read.append(line.strip())
+            name = line[1:]
+        elif line.startswith('+'):
+            quality = sum(map(len, read))
+        elif line:
+            read.append(line)
 
-    if name != '':
-        fastq_dict[name] = ''.join(read)
+    if name is not None:
+        yield name, ''.join(read)
 
-    return fastq_dict
-    
-def process_file(fasta_dict: dict, filename: str) -> str:
-    """Create a file containing the name of each string 
-    with their suffix array, their bucket dict and their O table
-    """    
-    filename = filename.split('.')[0]
-    file = filename + '_prepro.txt'
-
-    with open(file, 'w') as f:
-        final = ''
-        for k, v in fasta_dict.items():
-            final += '>' + k + '\n'
-            Rsa, sa, C, RO, O = bwt_C_O(v)
-            final += str(Rsa) + '\n'
-            final += str(sa) + '\n'
-            final += str(C) + '\n'
-            final += str(RO) + '\n'
-            final += str(O) + '\n'
-        f.writelines(final)
+def write_sam(sams, out, buffer_size: int = 1 << 16):
+    """Write Simple-SAM lines to out in chunks of about buffer_size
+    characters rather than one write per hit.
+    """
+    chunk, size = [], 0
+    for sam in sams:
+        chunk.append(sam)
+        size += len(sam)
+        if size >= buffer_size:
+            chunk.append('')
+            out.write('\n'.join(chunk))
+            chunk, size = [], 0
+    if chunk:
+        chunk.append('')
+        out.write('\n'.join(chunk))
+    out.flush()
     
+class BackgroundGzipReader(io.RawIOBase):
+    """The decompressed contents of the gzip file f as a raw stream.
+
+    A background thread reads and inflates f a block at a time, keeping
+    up to depth blocks ahead of the reader, so decompression overlaps
+    with whatever consumes the stream (zlib releases the GIL while it
+    works). Files of several concatenated gzip members, as written by
+    ParallelGzipWriter, bgzip or pigz, are read through to the end.
+
+    >>> data = gzip.compress(b'@r1\\nacgt\\n') + gzip.compress(b'@r2\\ngg\\n')
+    >>> io.BufferedReader(BackgroundGzipReader(io.BytesIO(data))).read()
+    b'@r1\\nacgt\\n@r2\\ngg\\n'
+    """
+
+    def __init__(self, f, block_size: int = 1 << 20, depth: int = 4):
+        super().__init__()
+        self.f = f
+        self.block_size = block_size
+        self.blocks = queue.Queue(depth)
+        self.stopping = threading.Event()
+        self.chunk = memoryview(b'')
+        self.done = False
+        self.thread = threading.Thread(target=self._inflate, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _inflate(self):
+        try:
+            member, started = zlib.decompressobj(31), False
+            for data in iter(lambda: self.f.read(self.block_size), b''):
+                while data:
+                    started = True
+                    out = member.decompress(data)
+                    if out and not self._put(out):
+                        return
+                    data = b''
+                    if member.eof: # the next member starts in the unused data
+                        data = member.unused_data
+                        member, started = zlib.decompressobj(31), False
+            if started:
+                raise EOFError('compressed file ended before the end-of-stream marker was reached')
+            self._put(b'')
+        except (OSError, EOFError, zlib.error) as err:
+            self._put(err)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.chunk:
+            if self.done:
+                return 0
+            item = self.blocks.get()
+            if not isinstance(item, bytes):
+                self.done = True
+                raise item
+            if item == b'':
+                self.done = True
+                return 0
+            self.chunk = memoryview(item)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.f.close()
+        super().close()
+
+def open_text(path: str):
+    """Open a FASTA or FASTQ file, or standard input for '-', as text.
+    Gzip-compressed input is recognised by its magic number and read
+    through a BackgroundGzipReader.
+    """
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        f = io.BufferedReader(BackgroundGzipReader(f), 1 << 16)
+    return io.TextIOWrapper(f, encoding='utf-8', errors='replace')
+
+class ParallelGzipWriter(io.RawIOBase):
+    """A raw stream that gzip-compresses what is written to it into the
+    binary file f.
+
+    The data is cut into blocks of block_size bytes, and each block is
+    compressed into a gzip member of its own by a pool of threads, with
+    at most two blocks per thread in flight. The members are written in
+    order, and concatenated members make a valid gzip file. Blocks are
+    only written when full or when the stream is closed.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'out.sam.gz')
+    >>> out = ParallelGzipWriter(open(path, 'wb'), threads=2, block_size=4)
+    >>> out.write(b'acgtacgtac'), out.close()
+    (10, None)
+    >>> with gzip.open(path) as f:
+    ...     f.read()
+    b'acgtacgtac'
+    """
+
+    def __init__(self, f, threads: int = 1, block_size: int = 1 << 20, level: int = 1):
+        super().__init__()
+        self.f = f
+        self.threads = threads
+        self.block_size = block_size
+        self.level = level
+        self.block = bytearray()
+        self.members = 0
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.block += b
+        while len(self.block) >= self.block_size:
+            self._submit(bytes(self.block[:self.block_size]))
+            del self.block[:self.block_size]
+        return len(b)
+
+    def _submit(self, block: bytes):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.level, mtime=0))
+        self.members += 1
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.block or self.members == 0: # an empty file still gets a member
+                self._submit(bytes(self.block))
+                self.block = bytearray()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.f.close()
+            super().close()
+
+def open_output(path: str = None, threads: int = 1):
+    """Open the Simple-SAM output as text: standard output for None or
+    '-', a ParallelGzipWriter with threads threads for a path ending in
+    .gz, and a plain file otherwise.
+    """
+    if path is None or path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedWriter(ParallelGzipWriter(open(path, 'wb'), threads), 1 << 16), encoding='utf-8')
+    return open(path, 'w')
+
+# On-disk index: a fixed header, the arrays of every section padded to
+# 8-byte boundaries, and a JSON table of contents at the end that records
+# where each array lives. Readers mmap the file and cast the arrays in
+# place, so loading an index copies nothing.
+INDEX_MAGIC = b'READMAP\0'
+INDEX_VERSION = 10
+INDEX_HEADER = struct.Struct('<8sIIQ') # magic, version, unused, toc offset
+
+class IndexFormatError(Exception):
+    """Raised when a file is not a readmap index we can read."""
+
+def _write_array(f, values) -> list:
+    """Write values as an unsigned int array at the next 8-byte boundary.
+
+    Returns:
+        list: The [typecode, offset, length] descriptor of the array.
+    """
+    f.write(b'\0' * (-f.tell() % 8))
+    arr = values if isinstance(values, array) else array('I', values)
+    offset = f.tell()
+    arr.tofile(f)
+    return [arr.typecode, offset, len(arr)]
+
+def _write_occ(f, O: OccTable) -> dict:
+    return {
+        'words': _write_array(f, O.words),
+        'counts': _write_array(f, O.counts),
+        'dollars': _write_array(f, O.dollars),
+    }
+
+# Sequences are indexed in shards of about this many symbols each.
+SHARD_SIZE = 1 << 26
+
+def shard_records(records, shard_size: int):
+    """Group (name, sequence) records into lists of consecutive records
+    with at most shard_size symbols in total, except that a longer
+    sequence gets a list of its own.
+
+    >>> [[name for name, seq in shard] for shard in shard_records(
+    ...     [('a', 'ac'), ('b', 'g'), ('c', 'gtac'), ('d', 'c')], 3)]
+    [['a', 'b'], ['c'], ['d']]
+    """
+    shard, size = [], 0
+    for name, seq in records:
+        if shard and size + len(seq) > shard_size:
+            yield shard
+            shard, size = [], 0
+        shard.append((name, seq))
+        size += len(seq)
+    if shard:
+        yield shard
+
+def sequence_checksum(seq: str) -> str:
+    """The checksum of a sequence kept in the index, as 16 hex digits."""
+    return hashlib.blake2b(seq.encode(), digest_size=8).hexdigest()
+
+def build_section(records: list, sa_step: int = 1, k: int = None) -> dict:
+    """Build the index section of records, see process_file.
+
+    Returns:
+        dict: The section, shaped like its table of contents entry but
+        with the arrays themselves in place of their descriptors, plus
+        its number of bases and build time in seconds.
+    """
+    t0 = time.perf_counter()
+    x, names, starts, seqs, rare = join_sequences(records)
+    sa, C, RO, O = bwt_C_O(x)
+    if k is None:
+        k = kmer_length(len(sa), SIGMA)
+    kmers = None
+    if k > 0:
+        table = build_kmer_table(C, O, len(sa), k)
+        kmers = {'k': k, 'L': table.L, 'R': table.R}
+    if sa_step > 1:
+        samples, bits, counts = sample_sa(sa, sa_step, starts)
+        sa = {'step': sa_step, 'samples': samples, 'bits': bits, 'counts': counts}
+    return {
+        'sequences': seqs,
+        'checksums': [sequence_checksum(seq) for name, seq in records],
+        'names': names,
+        'starts': starts,
+        'rare': rare,
+        'n': len(x) + 1, # suffix array rows, the final '$' included
+        'C': C,
+        'sa': sa,
+        'RO': RO,
+        'O': O,
+        'text': pack_codes(encode(x)),
+        'kmers': kmers,
+        'bp': sum(len(seq) for name, seq in records),
+        'seconds': time.perf_counter() - t0,
+    }
+
+def _write_section(f, section: dict) -> dict:
+    """Write the arrays of a build_section result to f and return its
+    table of contents entry."""
+    sa, kmers = section['sa'], section['kmers']
+    if isinstance(sa, dict):
+        sa = dict(sa, **{key: _write_array(f, sa[key]) for key in ('samples', 'bits', 'counts')})
+    else:
+        sa = _write_array(f, sa)
+    if kmers is not None:
+        kmers = dict(kmers, L=_write_array(f, kmers['L']), R=_write_array(f, kmers['R']))
+    return {
+        'sequences': section['sequences'],
+        'checksums': section['checksums'],
+        'names': section['names'],
+        'starts': _write_array(f, section['starts']),
+        'rare': section['rare'],
+        'n': section['n'],
+        'C': section['C'],
+        'sa': sa,
+        'RO': _write_occ(f, section['RO']),
+        'O': _write_occ(f, section['O']),
+        'text': _write_array(f, section['text']),
+        'kmers': kmers,
+    }
+
+def _copy_section(f, data: memoryview, entry: dict) -> dict:
+    """Copy the arrays of the section of another index with table of
+    contents entry entry, where data holds that index, to f and return
+    the entry of the copy."""
+    def copy(desc: list) -> list:
+        typecode, offset, length = desc
+        f.write(b'\0' * (-f.tell() % 8))
+        moved = [typecode, f.tell(), length]
+        f.write(data[offset:offset + length * array(typecode).itemsize])
+        return moved
+
+    sa, kmers = entry['sa'], entry['kmers']
+    if isinstance(sa, dict):
+        sa = dict(sa, **{key: copy(sa[key]) for key in ('samples', 'bits', 'counts')})
+    else:
+        sa = copy(sa)
+    if kmers is not None:
+        kmers = dict(kmers, L=copy(kmers['L']), R=copy(kmers['R']))
+    occ = lambda desc: {key: copy(value) for key, value in desc.items()}
+    return dict(entry, starts=copy(entry['starts']), sa=sa, RO=occ(entry['RO']), O=occ(entry['O']),
+                text=copy(entry['text']), kmers=kmers)
+
+def plan_update(records: list, sections: list) -> list:
+    """Plan an update of an index with sections, its table of contents
+    entries, to the sequences of records, a list of (name, checksum)
+    pairs in FASTA order.
+
+    Walking through records, a section whose sequences come next, with
+    the same names and checksums and in the same order, is kept;
+    the records in between are built again.
+
+    Returns:
+        list: (entry, count) pairs covering records in order: count
+        records for which the section with entry is kept or, if entry
+        is None, that must be built.
+
+    >>> old = [{'sequences': [['a', 5], ['b', 3]], 'checksums': ['1', '2']},
+    ...        {'sequences': [['c', 4]], 'checksums': ['3']}]
+    >>> plan = plan_update([('a', '1'), ('b', '2'), ('c', '9'), ('d', '4')], old)
+    >>> [(entry and entry['checksums'], count) for entry, count in plan]
+    [(['1', '2'], 2), (None, 2)]
+    >>> plan = plan_update([('new', '0'), ('c', '3'), ('a', '1')], old)
+    >>> [(entry and entry['checksums'], count) for entry, count in plan]
+    [(None, 1), (['3'], 1), (None, 1)]
+    """
+    starting = {} # the sections starting with each (name, checksum)
+    for entry in sections:
+        key = [(name, checksum) for (name, length), checksum in zip(entry['sequences'], entry['checksums'])]
+        if key:
+            starting.setdefault(key[0], []).append((key, entry))
+    plan, i = [], 0
+    while i < len(records):
+        for key, entry in starting.get(records[i], []):
+            if records[i:i + len(key)] == key:
+                plan.append((entry, len(key)))
+                i += len(key)
+                break
+        else:
+            if plan and plan[-1][0] is None:
+                plan[-1] = (None, plan[-1][1] + 1)
+            else:
+                plan.append((None, 1))
+            i += 1
+    return plan
+
+def _build_section(args: tuple) -> dict:
+    return build_section(*args)
+
+def process_file(records, file: str, sa_step: int = 1, k: int = None, shard_size: int = SHARD_SIZE, threads: int = 1, log=None,
+                 reuse: tuple = None) -> str:
+    """Create the index file over the sequences in records.
+
+    The sequences are grouped by shard_records, and each shard becomes
+    a section over its fragments joined by '$' (see join_sequences),
+    containing the suffix array, the C table, the O tables, the table
+    of where each fragment starts, the runs of rare symbols, the
+    joined text itself packed two bits per base and the KmerTable for
+    strings up to length k (default kmer_length, 0 for none). With
+    sa_step > 1 only every sa_step'th text position is kept in the
+    suffix array.
+
+    With threads > 1 the shards are built by a pool of worker
+    processes. Either way a section is written as soon as it and the
+    ones before it are done, so at most threads shards are held in
+    memory at a time. A line per shard with its sequences, size and
+    build time is written to log, if given. The index is written under
+    a temporary name and renamed to file when it is complete, so file
+    is never seen half written.
+
+    With reuse, a pair (data, plan) of the bytes of an earlier index
+    built with the same options and a plan_update of it to records,
+    the sections the plan keeps are copied from data instead of built,
+    and the records they cover are skipped. Only the runs of records
+    in between are sharded and built.
+    """
+    t0 = time.perf_counter()
+    partial = f'{file}.{os.getpid()}.tmp'
+
+    def report(section: dict):
+        if log is not None:
+            print(f"readmap: indexed {', '.join(name for name, length in section['sequences'])} "
+                  f"({section['bp']} bp) in {section['seconds']:.2f}s",
+                  file=log, flush=True)
+
+    def jobs():
+        # (entry, None) for a section to copy, (None, args) for one to
+        # build with _build_section(args).
+        if reuse is None:
+            yield from ((None, (shard, sa_step, k)) for shard in shard_records(records, shard_size))
+            return
+        data, plan = reuse
+        it = iter(records)
+        for entry, count in plan:
+            run = itertools.islice(it, count)
+            if entry is None:
+                yield from ((None, (shard, sa_step, k)) for shard in shard_records(run, shard_size))
+            else:
+                collections.deque(run, maxlen=0) # skip the records it covers
+                yield entry, None
+
+    def copy(entry: dict) -> dict:
+        section = _copy_section(f, reuse[0], entry)
+        if log is not None:
+            print(f"readmap: kept {', '.join(name for name, length in entry['sequences'])} "
+                  f"({sum(length for name, length in entry['sequences'])} bp)",
+                  file=log, flush=True)
+        return section
+
+    try:
+        with open(partial, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, 0))
+            sections = []
+            if threads <= 1:
+                for entry, shard in jobs():
+                    if entry is not None:
+                        sections.append(copy(entry))
+                        continue
+                    section = _build_section(shard)
+                    sections.append(_write_section(f, section))
+                    report(section)
+            else:
+                with multiprocessing.Pool(threads) as pool:
+                    pending = collections.deque()
+                    for job in itertools.chain(jobs(), [None]):
+                        if job is not None:
+                            entry, shard = job
+                            pending.append((entry, shard and pool.apply_async(_build_section, (shard,))))
+                        while pending and (job is None or len(pending) >= threads):
+                            entry, built = pending.popleft()
+                            if entry is not None:
+                                sections.append(copy(entry))
+                                continue
+                            section = built.get()
+                            sections.append(_write_section(f, section))
+                            report(section)
+            toc_offset = f.tell()
+            f.write(json.dumps({
+                'byteorder': sys.byteorder,
+                'itemsize': array('I').itemsize,
+                'sections': sections,
+            }).encode())
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, toc_offset))
+    except BaseException:
+        os.unlink(partial)
+        raise
+    os.replace(partial, file)
+
+    if log is not None:
+        print(f"readmap: wrote {file} with {len(sections)} sections in {time.perf_counter() - t0:.2f}s",
+              file=log, flush=True)
     return file
 
-def D_table(Rsa: list, C: dict, RO: dict, fastq: str, edit_limit) -> list:
-        
-    L, R = 0, len(Rsa)
+# The environment variable naming the default index directory.
+INDEX_DIR_ENV = 'READMAP_INDEX_DIR'
+
+def genome_digest(genome: str) -> str:
+    """A hash of the content of the genome file, as 16 hex digits."""
+    h = hashlib.blake2b(digest_size=8)
+    with open(genome, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def index_name(genome: str, digest: str, sa_step: int = 1, k: int = None, shard_size: int = SHARD_SIZE) -> str:
+    """The file name of the index of a genome file with the content
+    digest, built by process_file with the given parameters.
+
+    >>> index_name('data/genome.fa', '0123456789abcdef', 4)
+    'genome.fa.0123456789abcdef.v10-s4-kauto-b67108864.idx'
+    """
+    k = 'auto' if k is None else k
+    return f'{os.path.basename(genome)}.{digest}.v{INDEX_VERSION}-s{sa_step}-k{k}-b{shard_size}.idx'
+
+def index_path(genome: str, sa_step: int = 1, k: int = None, shard_size: int = SHARD_SIZE, index_dir: str = None, digest: str = None) -> str:
+    """Where the index of genome built with the given parameters is
+    kept: its index_name in index_dir, by default the directory named
+    by $READMAP_INDEX_DIR or else the genome's own. As the name holds
+    a hash of the genome, an index is never used for a genome that has
+    changed since, and genomes with the same name do not collide.
+    """
+    if index_dir is None:
+        index_dir = os.environ.get(INDEX_DIR_ENV) or os.path.dirname(genome)
+    if digest is None:
+        digest = genome_digest(genome)
+    return os.path.join(index_dir, index_name(genome, digest, sa_step, k, shard_size))
+
+def _usable_index(file: str) -> bool:
+    try:
+        load_index(file)
+    except (FileNotFoundError, IndexFormatError):
+        return False
+    return True
+
+def _earlier_index(genome: str, file: str) -> str:
+    """The newest index in the directory of file of another version of
+    genome, built with the same options, or None."""
+    folder = os.path.dirname(file) or '.'
+    prefix = f'{os.path.basename(genome)}.'
+    options = os.path.basename(file)[len(prefix):].partition('.')[2]
+    others = [os.path.join(folder, name) for name in os.listdir(folder)
+              if name.startswith(prefix) and name[len(prefix):].partition('.')[2] == options]
+    for other in sorted(others, key=os.path.getmtime, reverse=True):
+        if other != file and _usable_index(other):
+            return other
+    return None
+
+def ensure_index(genome: str, sa_step: int = 1, k: int = None, shard_size: int = SHARD_SIZE, index_dir: str = None,
+                 threads: int = 1, log=None, exact: bool = True, update: bool = False) -> str:
+    """The index_path of genome, after building it with process_file if
+    it is missing or cannot be loaded.
+
+    With update, the build starts from the newest index of an earlier
+    version of the genome with the same name and options, if there is
+    one: the sequences of the genome are checksummed, and the sections
+    of that index whose sequences are unchanged are kept (see
+    plan_update), so only added and changed sequences are indexed and
+    removed ones are dropped. The earlier index is left in place.
+
+    Builds hold an exclusive flock on a lock file next to the index
+    and look for the index again once they have it, so concurrent calls
+    build it once and the others wait and use it. The lock file is
+    removed once the index is there. Without exact, an
+    index of the genome built with other parameters is used, the newest
+    first, if there is none with these.
+
+    Returns:
+        str: The index file.
+
+    An updated index maps reads like one built from scratch:
+
+    >>> import io, tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> genome = os.path.join(folder, 'genome.fa')
+    >>> def hits(index):
+    ...     return sorted(line for read in ('acgtac', 'ttgcaa') for sam in map_read(index, 'r1', read, 1) for line in sam.splitlines())
+    >>> def update(records):
+    ...     with open(genome, 'w') as f:
+    ...         f.writelines(f'>{name}\\n{seq}\\n' for name, seq in records)
+    ...     log = io.StringIO()
+    ...     index = load_index(ensure_index(genome, shard_size=20, index_dir=folder, log=log, update=True))
+    ...     return hits(index), [line.split()[1] for line in log.getvalue().splitlines()[1:-1]]
+    >>> old = [('chr1', 'acgtacgtaNNNNacgttgca'), ('chr2', 'ttgcaacgtnacgtac'), ('chr3', 'gattacaacgtaccc')]
+    >>> new = [old[0], ('chr2', 'ttgcaacgtaacgtac'), old[2], ('chr4', 'cccttgcaaggg')]
+    >>> update(old)[1]
+    ['indexed', 'indexed', 'indexed']
+    >>> updated, log = update(new)
+    >>> log
+    ['kept', 'indexed', 'kept', 'indexed']
+    >>> updated == hits(load_index(process_file(new, os.path.join(folder, 'fresh.idx'), shard_size=20)))
+    True
+    """
+    digest = genome_digest(genome)
+    file = index_path(genome, sa_step, k, shard_size, index_dir, digest)
+    if _usable_index(file):
+        return file
+    folder = os.path.dirname(file) or '.'
+    if not exact and os.path.isdir(folder):
+        prefix = f'{os.path.basename(genome)}.{digest}.v{INDEX_VERSION}-'
+        others = [os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.startswith(prefix) and name.endswith('.idx')]
+        for other in sorted(others, key=os.path.getmtime, reverse=True):
+            if _usable_index(other):
+                return other
+
+    os.makedirs(folder, exist_ok=True)
+    with open(file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not _usable_index(file): # unless it was built while we waited
+            earlier = _earlier_index(genome, file) if update else None
+            reuse = None
+            if earlier is not None:
+                buf, toc = read_toc(earlier)
+                with open_text(genome) as f:
+                    records = [(name, sequence_checksum(seq)) for name, seq in fasta_func(f)]
+                reuse = (memoryview(buf), plan_update(records, toc['sections']))
+            if log is not None:
+                source = f" from {earlier}" if earlier is not None else ""
+                print(f"readmap: building {file}{source}", file=log, flush=True)
+            with open_text(genome) as f:
+                process_file(fasta_func(f), file, sa_step, k, shard_size, threads, log, reuse)
+            # Calls still waiting for the lock then find the index.
+            os.unlink(lock.name)
+    return file
+
+def index_fingerprint(file: str) -> str:
+    """A short hash identifying an index file: its table of contents,
+    size and modification time. It changes whenever the index is
+    rebuilt.
+    """
+    st = os.stat(file)
+    with open(file, 'rb') as f:
+        header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            raise IndexFormatError(f'{file} is not a readmap index')
+        f.seek(INDEX_HEADER.unpack(header)[3])
+        toc = f.read()
+    return hashlib.blake2b(toc + f'{st.st_size}:{st.st_mtime_ns}'.encode(), digest_size=8).hexdigest()
+
+def read_toc(file: str) -> tuple:
+    """Memory-map an index written by process_file and read its table
+    of contents.
+
+    Returns:
+        tuple: The mapped file and the table of contents.
+
+    Raises:
+        IndexFormatError: If file is not an index of the current version.
+    """
+    with open(file, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            raise IndexFormatError(f'{file} is not a readmap index')
+    if len(buf) < INDEX_HEADER.size:
+        raise IndexFormatError(f'{file} is not a readmap index')
+    magic, version, _, toc_offset = INDEX_HEADER.unpack_from(buf)
+    if magic != INDEX_MAGIC:
+        raise IndexFormatError(f'{file} is not a readmap index')
+    if version != INDEX_VERSION:
+        raise IndexFormatError(
+            f'{file} has index version {version}, expected {INDEX_VERSION}; '
+            'rerun readmap -p')
+    if not INDEX_HEADER.size <= toc_offset <= len(buf):
+        raise IndexFormatError(f'{file} is truncated')
+    try:
+        toc = json.loads(buf[toc_offset:])
+    except ValueError:
+        raise IndexFormatError(f'{file} has a corrupt table of contents')
+    if toc['byteorder'] != sys.byteorder \
+            or toc['itemsize'] != array('I').itemsize:
+        raise IndexFormatError(f'{file} was built on an incompatible machine')
+    return buf, toc
+
+def load_index(file: str) -> list:
+    """Memory-map an index written by process_file.
+
+    Returns:
+        list[dict]: One dict per section with its sequences, fragment
+        names and starts, runs of rare symbols, C table, the sa,
+        RO, O and packed text arrays as views into the mapped file, its
+        KmerTable or None, and its MaskedRuns or None if nothing is
+        masked.
+
+    Raises:
+        IndexFormatError: If file is not an index of the current version.
+    """
+    buf, toc = read_toc(file)
+    toc_offset = INDEX_HEADER.unpack_from(buf)[3]
+    data = memoryview(buf)
+    def view(desc: list) -> memoryview:
+        typecode, offset, length = desc
+        end = offset + length * array(typecode).itemsize
+        if end > toc_offset:
+            raise IndexFormatError(f'{file} is truncated')
+        return data[offset:end].cast(typecode)
+
+    def occ(desc: dict) -> OccTable:
+        return OccTable(view(desc['words']), view(desc['counts']), view(desc['dollars']))
+
+    index = []
+    for section in toc['sections']:
+        C, O = section['C'], occ(section['O'])
+        sa = section['sa']
+        if isinstance(sa, dict):
+            sa = SampledSA(sa['step'], section['n'], view(sa['samples']),
+                           view(sa['bits']), view(sa['counts']), C, O)
+        else:
+            sa = view(sa)
+        kmers = section['kmers']
+        if kmers is not None:
+            kmers = KmerTable(kmers['k'], view(kmers['L']), view(kmers['R']))
+        text = view(section['text'])
+        index.append({
+            'sequences': section['sequences'],
+            'names': section['names'],
+            'starts': view(section['starts']),
+            'rare': section['rare'],
+            'n': section['n'],
+            'C': C,
+            'sa': sa,
+            'RO': occ(section['RO']),
+            'O': O,
+            'text': text,
+            'kmers': kmers,
+            'masked': MaskedRuns(section['rare'], text) or None,
+        })
+    return index
+
+class Stats:
+    """Counters and phase timers for readmap --stats.
+
+    Instrumented code reads the module global STATS, which is None
+    unless --stats is given, and only counts when it is set; the checks
+    are made once per search state or per call, not per symbol.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self.max_hits = 0
+
+    def add(self, name: str, n: int = 1):
+        self.counts[name] += n
+
+    def time(self, phase: str, seconds: float):
+        self.seconds[phase] += seconds
+
+    def timed(self, phase: str, iterable):
+        """Yield from iterable, adding the time spent waiting for its
+        items to phase."""
+        it, clock = iter(iterable), time.perf_counter
+        while True:
+            t0 = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.seconds[phase] += clock() - t0
+                return
+            self.seconds[phase] += clock() - t0
+            yield item
+
+    def read_done(self, hits: int):
+        self.counts['reads'] += 1
+        self.counts['reads with hits'] += hits > 0
+        self.counts['hits'] += hits
+        self.max_hits = max(self.max_hits, hits)
+
+    def take(self) -> dict:
+        """The counters and timers collected so far, which are reset."""
+        taken = {'counts': dict(self.counts), 'seconds': dict(self.seconds), 'max_hits': self.max_hits}
+        self.__init__()
+        return taken
+
+    def merge(self, taken: dict):
+        """Add the counters and timers of another Stats' take()."""
+        self.counts.update(taken['counts'])
+        self.seconds.update(taken['seconds'])
+        self.max_hits = max(self.max_hits, taken['max_hits'])
+
+    def summary(self) -> dict:
+        """A JSON-ready summary. The search time is the mapping time
+        without locating and formatting hits, and the output time is the
+        time spent writing without the time spent waiting for hits. The
+        pipeline part has the busy and idle seconds of each stage of
+        map_pipeline; the stage that is busy the most sets the pace.
+
+        >>> stats = Stats()
+        >>> stats.read_done(3); stats.read_done(0); stats.add('rank calls', 4)
+        >>> stats.time('map', 1.0); stats.time('locate', 0.25)
+        >>> summary = stats.summary()
+        >>> summary['hits per read'], summary['search']['rank calls'], summary['seconds']['search']
+        ({'mean': 1.5, 'max': 3}, 4, 0.75)
+        """
+        counts, seconds = self.counts, self.seconds
+        search = {name: n for name, n in sorted(counts.items())
+                  if name not in ('reads', 'reads with hits', 'hits')}
+        phases = {
+            'parse': seconds['parse'],
+            'index load': seconds['index load'],
+            'search': seconds['map'] - seconds['locate'] - seconds['cigar'],
+            'locate': seconds['locate'],
+            'cigar': seconds['cigar'],
+            'output': seconds['write'] - seconds['wait'],
+            'total': seconds['total'],
+        }
+        return {
+            'reads': counts['reads'],
+            'reads with hits': counts['reads with hits'],
+            'hits': counts['hits'],
+            'hits per read': {
+                'mean': counts['hits'] / counts['reads'] if counts['reads'] else 0,
+                'max': self.max_hits,
+            },
+            'search': search,
+            'seconds': {phase: round(t, 6) for phase, t in phases.items()},
+            'pipeline': {stage: {kind: round(seconds[f'{stage} {kind}'], 6) for kind in ('busy', 'input wait', 'output wait')}
+                         for stage in ('read', 'map', 'write')},
+        }
+
+# The Stats being collected, or None; see Stats.
+STATS = None
+
+def D_table(n: int, C: list, RO: OccTable, fastq: str, edit_limit) -> list:
+    """Lower bounds on the edits needed to match each prefix of fastq.
+
+    D[i] is the number of disjoint substrings of fastq[:i+1] that do
+    not occur in the text, found greedily by searching fastq forwards in
+    the reversed text. Each of them needs at least one edit.
+
+    Returns:
+        list: D, or [] if the read needs more than edit_limit edits.
+
+    >>> sa, C, RO, O = bwt_C_O('aaca')
+    >>> D_table(len(sa), C, RO, 'acca', 2), D_table(len(sa), C, RO, 'acca', 0)
+    ([0, 0, 1, 1], [])
+    """
+    rank = RO.rank
+    L, R = 0, n
     D = []
     edits = 0
-    for char in fastq: # O(m)
-        L = C[char] + RO[char][L] # O(1)
-        R = C[char] + RO[char][R]
-        if edits <= edit_limit:
-            if L == R or char not in C:
-                edits += 1
-                D.append(edits)
-                L, R = 0, len(Rsa)
-            else:
-                D.append(edits)
-        else:
-            D = []
+    for char in encode(fastq): # O(m)
+        if char < SIGMA:
+            L = C[char] + rank(char, L) # O(1)
+            R = C[char] + rank(char, R)
+        if char >= SIGMA or L == R:
+            edits += 1
+            if edits > edit_limit:
+                if STATS is not None:
+                    STATS.add('D table rank calls', 2 * (len(D) + 1))
+                    STATS.add('D table rejects')
+                return []
+            L, R = 0, n
+        D.append(edits)
+    if STATS is not None:
+        STATS.add('D table rank calls', 2 * len(D))
     return D
 
 def split_blocks(x: str):
@@ -194,144 +1513,1574 @@ def edits_to_cigar(edits: str) -> str:
         cigar += str(len(C)) + C[0]
     return cigar
 
-def approx_fm_search(genomename: str, sa: list, C: dict, O: dict, fastq: str, readname: str, D: list, edit_limit: int) -> str:
+# Edit operations in an EditTrace.
+MATCH, INSERTION, DELETION = range(3)
+EDIT_OPS = 'MID'
 
-    
-    L, R = 0, len(sa)
-    j = 0
-    p = ''.join(reversed(fastq))
-        
-    res = {} # {edits: (L, R, cigar)}
-    queue = [(0, L, R, "", j)] # (edits, L, R, cigar, j)
-    while queue:
+class EditTrace:
+    """The edit paths of a search, as a graph of its states.
 
-        edits, L, R, cigar, j = queue.pop()
-        
-        if j == len(p) and edits <= edit_limit: # add result
-            if edits in res:
-                res[edits].append((L, R, cigar))
-            else:
-                res[edits] = [(L, R, cigar)]
-            j = 0
-            continue
-        
-        d = D[j] # Worth doing D or I or going on with a mismatch?
+    State 0 is the start of the search. Every push adds an edge (op,
+    source) into its target state, saying the target is reached from
+    source by op, so states merged by the search share the paths that
+    lead to them and a push costs O(1) whatever the number of paths.
+    The edges live in flat arrays, each state's incoming edges linked
+    through next from head[state].
+
+    A search that prepends each op to its edit strings, like a backward
+    search, gets the paths back in CIGAR order by walking from a state
+    to state 0:
+
+    >>> trace, level = EditTrace(), {}
+    >>> trace.push(level, 'a', MATCH, 0)
+    >>> trace.push(level, 'b', INSERTION, level['a'])
+    >>> trace.push(level, 'b', MATCH, level['a'])
+    >>> trace.push(level, 'c', MATCH, level['b'])
+    >>> sorted(trace.cigars(level['c']))
+    [('1M1I1M', 2), ('3M', 3)]
+    """
+
+    def __init__(self):
+        self.head = array('i', [-1])
+        self.op = array('B')
+        self.source = array('i')
+        self.next = array('i')
+
+    def push(self, level: dict, key, op: int, source: int):
+        """Add an edge by op from state source to the state of key in
+        level, a dict of states, adding the state if it is new."""
+        target = level.get(key)
+        if target is None:
+            target = level[key] = len(self.head)
+            self.head.append(-1)
+        self.next.append(self.head[target])
+        self.head[target] = len(self.op)
+        self.op.append(op)
+        self.source.append(source)
+
+    def cigars(self, state: int) -> list:
+        """The CIGAR of every path to state, with the number of text
+        symbols it covers. The CIGARs are run-length encoded while the
+        paths are walked."""
+        head, ops, source, next_edge = self.head, self.op, self.source, self.next
+        found = []
+        stack = [(state, '', MATCH, 0, 0)] # state, CIGAR so far, last op and its run, text length
+        while stack:
+            s, cigar, last, run, length = stack.pop()
+            e = head[s]
+            if e < 0: # back at the start
+                found.append((cigar + f'{run}{EDIT_OPS[last]}' if run else cigar, length))
+            while e >= 0:
+                op = ops[e]
+                covered = length + (op != INSERTION)
+                if op == last:
+                    stack.append((source[e], cigar, op, run + 1, covered))
+                else:
+                    stack.append((source[e], cigar + f'{run}{EDIT_OPS[last]}' if run else cigar, op, 1, covered))
+                e = next_edge[e]
+        return found
+
+def approx_fm_search(names: list, starts: array, sa: list, C: list, O: OccTable, fastq: str, readname: str, D: list, edit_limit: int, kmers: KmerTable = None, max_hits: int = None, masked: MaskedRuns = None) -> str:
+    """Find all alignments of fastq with at most edit_limit edits.
+
+    The search runs backwards through the read. A search state is the
+    number j of read symbols matched so far, the edits used, and the
+    suffix array interval [L, R) of the text matched. States are
+    expanded level by level, in order of j and then edits, so that all
+    the ways of reaching the same state are merged before it is
+    expanded: the EditTrace then keeps every path leading to it and its
+    subtree is searched only once. Branches are cut when they push
+    an empty interval, or when D shows the rest of the read cannot be
+    matched with the edits that are left.
+
+    With a KmerTable, intervals of text strings shorter than kmers.k are
+    looked up instead of computed by rank. Hits are reported in order of
+    edits, and at most max_hits of them (see format_hits).
+    """
+    stats = STATS
+    rank = O.rank
+    p = encode(fastq)[::-1]
+    m = len(p)
+    alphabet = range(SIGMA)
+
+    # The number and length of a text string for intervals that were
+    # found in kmers; any string with the interval will do.
+    known = {(0, len(sa)): (0, 0)} if kmers else {}
 
-        if j < len(p) and d <= edit_limit: # O(m)
-            # Update 29-11-22: add letters to cigar from the front since we move through p from the back
+    def lookup(i: int, d: int) -> list:
+        children = []
+        for char in alphabet:
+            ci = kmers.extend(char, i, d)
+            l, r = kmers.L[ci], kmers.R[ci]
+            if l < r and d + 1 < kmers.k:
+                known.setdefault((l, r), (ci, d + 1))
+            children.append((char, l, r))
+        return children
 
-            if L != R: # Match
-                queue.append((edits, C[p[j]] + O[p[j]][L], C[p[j]] + O[p[j]][R], 'M'+cigar, j+1))
+    # Edits still needed for the unmatched read prefix after j steps.
+    need = [D[m-j-1] for j in range(m)] + [0]
+    # levels[j][edits] maps (L, R) to the EditTrace state reached.
+    levels = [[{} for _ in range(edit_limit + 1)] for _ in range(m + 1)]
+    levels[0][0][(0, len(sa))] = 0
+    trace = EditTrace()
+    push = trace.push
 
-            if edits < edit_limit: 
-                # Mismatch
-                for char in C.keys():
-                    if char != '$' and char != p[j]:
-                        queue.append((edits+1, C[char] + O[char][L], C[char] + O[char][R], 'M'+cigar, j+1))
-            
-                # Insertion
-                queue.append((edits+1, L, R, 'I'+cigar, j+1))
+    for j in range(m):
+        for edits in range(edit_limit + 1):
+            for (L, R), state in levels[j][edits].items():
+                # Update 29-11-22: add letters to cigar from the front since we move through p from the back
+                if edits == edit_limit: # Only a match is possible
+                    char = p[j]
+                    if need[j+1] == 0 and char < SIGMA:
+                        if stats is not None:
+                            stats.add('states expanded')
+                            if (L, R) in known:
+                                stats.add('kmer lookups')
+                            else:
+                                stats.add('rank calls', 2)
+                        if (L, R) in known:
+                            i, d = known[(L, R)]
+                            i = kmers.extend(char, i, d)
+                            l, r = kmers.L[i], kmers.R[i]
+                            if l < r and d + 1 < kmers.k:
+                                known.setdefault((l, r), (i, d + 1))
+                        else:
+                            l, r = C[char] + rank(char, L), C[char] + rank(char, R)
+                        if stats is not None:
+                            stats.add('pushes match' if l < r else 'empty intervals')
+                        if l < r:
+                            push(levels[j+1][edits], (l, r), MATCH, state)
+                    continue
+
+                if (L, R) in known:
+                    children = lookup(*known[(L, R)])
+                    if stats is not None:
+                        stats.add('kmer lookups', len(children))
+                else:
+                    children = [(char, C[char] + rank(char, L), C[char] + rank(char, R))
+                                for char in alphabet]
+                    if stats is not None:
+                        stats.add('rank calls', 2 * len(children))
+
+                if stats is not None:
+                    found = [char for char, l, r in children if l < r]
+                    stats.add('states expanded')
+                    stats.add('empty intervals', len(children) - len(found))
+                    if edits + need[j+1] <= edit_limit:
+                        stats.add('pushes match', p[j] in found)
+                    if edits + 1 + need[j+1] <= edit_limit:
+                        stats.add('pushes mismatch', len(found) - (p[j] in found))
+                        stats.add('pushes insertion')
+                    if j != 0 and edits + 1 + need[j] <= edit_limit:
+                        stats.add('pushes deletion', len(found))
+
+                if edits + need[j+1] <= edit_limit: # Match
+                    for char, l, r in children:
+                        if char == p[j] and l < r:
+                            push(levels[j+1][edits], (l, r), MATCH, state)
+
+                if edits + 1 + need[j+1] <= edit_limit:
+                    # Mismatch
+                    for char, l, r in children:
+                        if char != p[j] and l < r:
+                            push(levels[j+1][edits+1], (l, r), MATCH, state)
+
+                    # Insertion
+                    push(levels[j+1][edits+1], (L, R), INSERTION, state)
 
                 # Deletion
-                if j != 0:
-                    for char in C.keys():
-                        if char != '$':
-                            queue.append((edits+1, C[char] + O[char][L], C[char] + O[char][R], 'D'+cigar, j))
-                            
-    final = []
-    
-    for edits, match in res.items():
-        
-        for L,R,cigar in match:
-            for i in range(L,R):
-                match = sa[i]+1
-                if edit_limit==0:
-                    text=str(len(p))+'M'
+                if j != 0 and edits + 1 + need[j] <= edit_limit:
+                    for char, l, r in children:
+                        if l < r:
+                            push(levels[j][edits+1], (l, r), DELETION, state)
+
+    hits = [(interval, trace.cigars(state)) for edits in range(edit_limit + 1)
+            for interval, state in levels[m][edits].items()]
+    return format_hits(names, starts, sa, hits, readname, fastq, max_hits, edit_limit, masked)
+
+def format_hits(names: list, starts: array, sa: list, hits, readname: str, fastq: str, max_hits: int = None,
+                edit_limit: int = 0, masked: MaskedRuns = None) -> str:
+    """Simple-SAM lines for every text position of every hit, in the
+    order of hits.
+
+    Suffix array rows are located one at a time as the lines are made,
+    so with max_hits only the rows needed for the first max_hits lines
+    are located; with a sampled suffix array those are the costly part.
+
+    Args:
+        hits: ((L, R), cigars) pairs; each suffix array row in [L, R)
+            is reported once for each (CIGAR, text length) in cigars.
+        max_hits (int): the most lines to make, or None for all.
+        masked (MaskedRuns): the section's masked symbols, if any;
+            hits with more than edit_limit edits once they are counted
+            as mismatches are left out.
+    """
+    stats = STATS
+    if stats is not None:
+        t0 = time.perf_counter()
+        located = stats.seconds['locate']
+
+    def lines():
+        for (L, R), cigars in hits:
+            for i in range(L, R):
+                if stats is not None:
+                    t = time.perf_counter()
+                    pos = sa[i]
+                    stats.time('locate', time.perf_counter() - t)
+                    stats.add('rows located')
                 else:
-                    text=f'{edits_to_cigar(cigar)}'
-                final.append('\t'.join([readname, genomename, str(match), text, fastq]))
-    if final == []:
-        return ''
-    return '\n'.join(final)
-
-def approximate_matching(prepro_file: str, fastq_dict: dict, edit_limit: int):
-    # give room for muliple fasta sequences
-    fastanames, Rsa_list, sa_list, C_list, O_list, RO_list = [], [], [], [], [], []
-
-    with open(prepro_file, 'r') as f: 
-        lines = f.readlines()
-        linecounter = 0
-        for line in lines:
-            linecounter += 1
-            if line.startswith('>'):
-                linecounter = 0
-                name = line[1:].strip()
-                fastanames.append(name)
+                    pos = sa[i]
+                for cigar, length in cigars:
+                    hit = to_chromosome(names, starts, pos, length)
+                    if hit is None: # spans a sequence boundary
+                        continue
+                    if masked is not None and not masked.allows(pos, length, cigar, fastq, edit_limit):
+                        continue
+                    genomename, match = hit
+                    yield '\t'.join([readname, genomename, str(match+1), cigar, fastq])
+
+    final = '\n'.join(itertools.islice(lines(), max_hits))
+    if stats is not None:
+        stats.time('cigar', time.perf_counter() - t0 - (stats.seconds['locate'] - located))
+    return final
+
+# A search scheme is a list of searches (order, L, U): the read is split
+# into len(order) parts, which are matched in the given order, and after
+# the i'th of them the edits used so far must be between L[i] and U[i].
+# Every order extends the matched part of the read one neighbour at a
+# time, so the search can proceed with a bidirectional index.
+SCHEMES = {
+    1: [((0, 1), (0, 0), (0, 1)),
+        ((1, 0), (0, 1), (0, 1))],
+    2: [((0, 1, 2), (0, 0, 0), (0, 2, 2)),
+        ((2, 1, 0), (0, 0, 0), (0, 1, 2)),
+        ((1, 0, 2), (0, 1, 1), (0, 1, 2))],
+}
+
+def pigeonhole_scheme(k: int) -> list:
+    """The scheme that splits the read into k+1 parts and, for each
+    part, matches it exactly before extending to the right and then to
+    the left with up to k edits.
+
+    >>> pigeonhole_scheme(1)
+    [((0, 1), (0, 0), (0, 1)), ((1, 0), (0, 0), (0, 1))]
+    """
+    scheme = []
+    for i in range(k + 1):
+        order = (i,) + tuple(range(i + 1, k + 1)) + tuple(range(i - 1, -1, -1))
+        scheme.append((order, (0,) * (k + 1), (0,) + (k,) * k))
+    return scheme
+
+def search_scheme(k: int) -> list:
+    """The search scheme used for k edits.
+
+    >>> all(scheme_covers(search_scheme(k), k) for k in range(5))
+    True
+    """
+    return SCHEMES.get(k) or pigeonhole_scheme(k)
+
+def scheme_covers(scheme: list, k: int) -> bool:
+    """Check that scheme finds every alignment with at most k edits.
+
+    An alignment is described by the edits inside each part and the
+    deletions between each pair of neighbouring parts. The search counts
+    a deletion between two parts towards the part it matches later,
+    since deletions are only made before a read symbol of the part
+    being extended.
+
+    >>> scheme_covers(pigeonhole_scheme(3), 3)
+    True
+    >>> scheme_covers(pigeonhole_scheme(3)[1:], 3)
+    False
+    """
+    parts = len(scheme[0][0])
+    for edits in itertools.product(range(k + 1), repeat=2 * parts - 1):
+        if sum(edits) > k:
+            continue
+        inside, between = edits[:parts], edits[parts:]
+        for order, L, U in scheme:
+            when = {part: t for t, part in enumerate(order)}
+            counts = list(inside)
+            for x, d in enumerate(between): # deletions between x and x+1
+                counts[max(x, x + 1, key=when.get)] += d
+            total = list(itertools.accumulate(counts[part] for part in order))
+            if all(lo <= e <= hi for lo, e, hi in zip(L, total, U)):
+                break
+        else:
+            return False
+    return True
+
+def _extend(C: list, O: OccTable, l: int, r: int, other: int) -> list:
+    """Extend a bidirectional interval by each code.
+
+    [l, r) is the interval in the index whose O table is O, and other
+    the start of the interval in the index of the reversed text. The
+    other interval of the extension by c starts after those of the
+    extensions by '$' and all codes smaller than c.
+
+    Returns:
+        list: (c, l, r, other) for every code c with a non-empty
+        extension.
+    """
+    ranks = [(O.rank(c, l), O.rank(c, r)) for c in range(SIGMA)]
+    other += r - l - sum(hi - lo for lo, hi in ranks) # the '$' extensions
+    children = []
+    for c, (lo, hi) in enumerate(ranks):
+        if lo < hi:
+            children.append((c, C[c] + lo, C[c] + hi, other))
+        other += hi - lo
+    return children
+
+def scheme_search(names: list, starts: array, sa: list, C: list, O: OccTable, RO: OccTable, fastq: str, readname: str, edit_limit: int, max_hits: int = None,
+                  masked: MaskedRuns = None) -> str:
+    """Find all alignments of fastq with at most edit_limit edits using
+    a search scheme over the bidirectional index made of O and RO.
+
+    Each search of the scheme starts from its first part and extends the
+    matched part of the read left, with O, or right, with RO. Searches
+    keep the edits within the bounds of the scheme, which cuts most of
+    the branches a plain backtracking search explores for larger
+    edit_limit. As in approx_fm_search, states are expanded level by
+    level so equal states are merged, and alignments found by several
+    searches are reported once.
+    """
+    scheme = search_scheme(edit_limit)
+    parts = len(scheme[0][0])
+    codes = encode(fastq)
+    m = len(fastq)
+    if m < parts:
+        D = D_table(len(sa), C, RO, fastq, edit_limit)
+        return approx_fm_search(names, starts, sa, C, O, fastq, readname, D, edit_limit, max_hits=max_hits, masked=masked) if D else ''
+    bounds = [m * i // parts for i in range(parts + 1)]
+
+    found = {} # (L, R) -> set of cigars
+    for order, lower, upper in scheme:
+        # The read position matched in each step, the direction, and
+        # the index into order of its part.
+        steps = []
+        for t, part in enumerate(order):
+            positions = range(bounds[part], bounds[part + 1])
+            right = part >= order[0]
+            steps.extend((i, right, t) for i in (positions if right else reversed(positions)))
+        last = [n + 1 == m or steps[n + 1][2] != steps[n][2] for n in range(m)]
+
+        # levels[n][edits] maps (L, R, RL) to the CIGARs that reach that
+        # state after n steps. Unlike in a backward search, L and R alone
+        # do not determine the text matched: 'ab' and 'abb' share them if
+        # every 'ab' is followed by 'b', but then extend differently.
+        levels = [[{} for _ in range(edit_limit + 1)] for _ in range(m + 1)]
+        levels[0][0][(0, len(sa), 0)] = ['']
+
+        def push(n, edits, L, R, RL, cigars):
+            levels[n][edits].setdefault((L, R, RL), []).extend(cigars)
+
+        for n in range(m):
+            i, right, t = steps[n]
+            char, u = codes[i], upper[t]
+            low = lower[t] if last[n] else 0
+            for edits in range(u + 1):
+                for (L, R, RL), cigars in levels[n][edits].items():
+                    if right:
+                        children = [(c, l, l + rr - rl, rl) for c, rl, rr, l in _extend(C, RO, RL, RL + R - L, L)]
+                        grow = lambda op: [c + op for c in cigars]
+                    else:
+                        children = _extend(C, O, L, R, RL)
+                        grow = lambda op: [op + c for c in cigars]
+
+                    for c, l, r, rl in children:
+                        e = edits + (c != char)
+                        if low <= e <= u: # Match or mismatch
+                            push(n + 1, e, l, r, rl, grow('M'))
+                    if edits < u:
+                        if low <= edits + 1: # Insertion
+                            push(n + 1, edits + 1, L, R, RL, grow('I'))
+                        if n > 0: # Deletion
+                            for c, l, r, rl in children:
+                                push(n, edits + 1, l, r, rl, grow('D'))
+
+        for edits in range(edit_limit + 1):
+            for (L, R, RL), cigars in levels[m][edits].items():
+                found.setdefault((L, R), set()).update(cigars)
+
+    # Sorted, so that the lines and the ones kept by max_hits do not
+    # depend on the order of the sets.
+    hits = [(interval, [(edits_to_cigar(c), len(c) - c.count('I')) for c in sorted(cigars)])
+            for interval, cigars in found.items()]
+    return format_hits(names, starts, sa, hits, readname, fastq, max_hits, edit_limit, masked)
+
+def fm_interval(C: list, O: OccTable, n: int, p: bytes, kmers: KmerTable = None) -> tuple:
+    """Suffix array interval [L, R) of the exact matches of the codes
+    p. With a KmerTable the search starts from the interval of p's last
+    kmers.k codes.
+
+    >>> sa, C, RO, O = bwt_C_O('gattacaatc')
+    >>> L, R = fm_interval(C, O, len(sa), encode('aat'))
+    >>> sorted(sa[i] for i in range(L, R))
+    [6]
+    >>> fm_interval(C, O, len(sa), encode('aat'), build_kmer_table(C, O, len(sa), 2)) == (L, R)
+    True
+    """
+    L, R = 0, n
+    if kmers:
+        split = max(len(p) - kmers.k, 0)
+        i = kmers.index(p[split:])
+        if i < 0:
+            return 0, 0
+        L, R, p = kmers.L[i], kmers.R[i], p[:split]
+    for char in reversed(p):
+        if char >= SIGMA or L == R:
+            return 0, 0
+        L, R = C[char] + O.rank(char, L), C[char] + O.rank(char, R)
+    return L, R
+
+def myers_columns(pattern: str, text: str):
+    """Yield the columns of the dynamic programming table of pattern
+    against the substrings of text ending at each position, with Myers'
+    bit-vector algorithm.
+
+    A column is kept as bit vectors of its vertical differences: bit i
+    of Pv is set where row i + 1 is one more than row i, and bit i of Mv
+    where it is one less. Each text symbol then costs a constant number
+    of operations on len(pattern)-bit integers. Both strings and symbol
+    codes will do for pattern and text.
+
+    Yields:
+        tuple: The edit distance between pattern and the best matching
+        substring of text ending at the position, Pv and Mv.
+
+    >>> [distance for distance, Pv, Mv in myers_columns('acg', 'tacgtcg')]
+    [3, 2, 1, 0, 1, 2, 1]
+    """
+    m = len(pattern)
+    mask, high = (1 << m) - 1, 1 << (m - 1)
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | 1 << i
+    Pv, Mv, score = mask, 0, m
+    for c in text:
+        Eq = peq.get(c, 0)
+        Xv = Eq | Mv
+        Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+        Ph = (Mv | ~(Xh | Pv)) & mask
+        Mh = Pv & Xh
+        if Ph & high:
+            score += 1
+        elif Mh & high:
+            score -= 1
+        Ph = (Ph << 1) & mask
+        Mh = (Mh << 1) & mask
+        Pv = (Mh | ~(Xv | Ph)) & mask
+        Mv = Ph & Xv
+        yield score, Pv, Mv
+
+_BIT_VALUES = bytes.maketrans(b'01', b'\0\1')
+
+def _column(Pv: int, Mv: int, m: int) -> list:
+    """The m + 1 values of a column of myers_columns, top row first."""
+    up = format(Pv, f'0{m}b')[::-1].encode().translate(_BIT_VALUES)
+    down = format(Mv, f'0{m}b')[::-1].encode().translate(_BIT_VALUES)
+    return list(map(int.__sub__, itertools.accumulate(up, initial=0), itertools.accumulate(down, initial=0)))
+
+def window_alignments(read: str, window: str, edit_limit: int):
+    """Yield every alignment of read to a substring of window with at
+    most edit_limit edits and no leading or trailing deletions, in order
+    of their end.
+
+    myers_columns finds the end columns of the window within edit_limit
+    of the read, and the alignments are traced back from those only,
+    through the dynamic programming table, where a cell's value bounds
+    the edits still needed, so only paths that can stay within
+    edit_limit are followed. No alignment reaches back more than
+    len(read) + edit_limit columns, so only the columns that close to an
+    end are worked out, from their bit vectors. The alignments ending in
+    a column depend only on the symbols that close to it, so in repeats
+    they are traced back once and reused.
+
+    Yields:
+        tuple: the start of the alignment in window and its edits.
+
+    >>> list(window_alignments('acg', 'tacgt', 1))
+    [(1, 'MMI'), (2, 'IMM'), (1, 'MMM')]
+    >>> list(window_alignments('acg', 'acgacga', 0))
+    [(0, 'MMM'), (3, 'MMM')]
+    """
+    m = len(read)
+    columns = [(m, (1 << m) - 1, 0)]
+    columns.extend(myers_columns(read, window))
+    dist = [None] * len(columns) # dist[j][i], for the columns near an end
+    traced = {}
+    for end in range(1, len(columns)):
+        if columns[end][0] > edit_limit:
+            continue
+        first = max(0, end - m - edit_limit)
+        key = window[first:end]
+        found = traced.get(key)
+        if found is None:
+            for j in range(first, end + 1):
+                if dist[j] is None:
+                    distance, Pv, Mv = columns[j]
+                    dist[j] = _column(Pv, Mv, m)
+            found = traced[key] = []
+            stack = [(m, end, 0, '')]
+            while stack:
+                i, j, edits, ops = stack.pop()
+                if i == 0:
+                    found.append((j - first, ops))
+                    continue
+                if j > 0: # Match or mismatch
+                    e = edits + (read[i-1] != window[j-1])
+                    if e + dist[j-1][i-1] <= edit_limit:
+                        stack.append((i - 1, j - 1, e, 'M' + ops))
+                if edits + 1 + dist[j][i-1] <= edit_limit: # Insertion
+                    stack.append((i - 1, j, edits + 1, 'I' + ops))
+                if 0 < j and i < m and edits + 1 + dist[j-1][i] <= edit_limit: # Deletion
+                    stack.append((i, j - 1, edits + 1, 'D' + ops))
+        for start, ops in found:
+            yield first + start, ops
+
+def seed_search(names: list, starts: array, sa: list, C: list, O: OccTable, RO: OccTable, text, fastq: str, readname: str, edit_limit: int, kmers: KmerTable = None, max_hits: int = None,
+                masked: MaskedRuns = None) -> str:
+    """Find all alignments of fastq with at most edit_limit edits by
+    seeding and extending.
+
+    The read is cut into edit_limit + 1 pieces, and by the pigeonhole
+    principle every alignment matches one of them exactly. The exact
+    matches of each piece give windows of the text that could hold an
+    alignment; overlapping windows are merged, and window_alignments
+    works out the alignments in each from the columns where
+    myers_columns finds one. Windows are unpacked from the packed text
+    and compared code by code. With max_hits, windows are checked in
+    text order only until that many alignments are found.
+    """
+    codes = encode(fastq)
+    m = len(fastq)
+    pieces = edit_limit + 1
+    if m < pieces:
+        D = D_table(len(sa), C, RO, fastq, edit_limit)
+        return approx_fm_search(names, starts, sa, C, O, fastq, readname, D, edit_limit, kmers, max_hits, masked) if D else ''
+    bounds = [m * i // pieces for i in range(pieces + 1)]
+
+    windows = []
+    for lo, hi in zip(bounds, bounds[1:]):
+        L, R = fm_interval(C, O, len(sa), codes[lo:hi], kmers)
+        for i in range(L, R):
+            pos = sa[i]
+            k = bisect.bisect_right(starts, pos) - 1
+            begin = max(pos - lo - edit_limit, starts[k])
+            end = min(pos - lo + m + 2 * edit_limit, starts[k+1] - 1)
+            windows.append((begin, end, k))
+    windows.sort()
+
+    final = []
+    merged = []
+    for begin, end, k in windows:
+        if merged and begin < merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end, k])
+    for begin, end, k in merged:
+        window = unpack_codes(text, begin, end)
+        name, offset = names[k]
+        for start, ops in window_alignments(codes, window, edit_limit):
+            cigar = edits_to_cigar(ops)
+            if masked is not None and not masked.allows(begin + start, len(ops) - ops.count('I'), cigar, fastq, edit_limit):
                 continue
-            l = ast.literal_eval(line.strip())
-            if linecounter == 1:
-                Rsa_list.append(l)
-            elif linecounter == 2:
-                sa_list.append(l)
-            elif linecounter == 3:
-                C_list.append(l) # convert back to dict
-            elif linecounter == 4:
-                RO_list.append(l) # convert back to dict
-            elif linecounter == 5:
-                O_list.append(l)
-    
-    for readname, read in fastq_dict.items():
-        for i, sa in enumerate(sa_list):
-            D = D_table(Rsa_list[i], C_list[i], RO_list[i], read, edit_limit)
-            if D != []:
-                simplesam = approx_fm_search(fastanames[i], sa_list[i], C_list[i], O_list[i], read, readname, D, edit_limit)
-                if simplesam != '':
-                    yield simplesam
+            match = offset + begin + start - starts[k]
+            final.append('\t'.join([readname, name, str(match+1), cigar, fastq]))
+        if max_hits is not None and len(final) >= max_hits:
+            break
+    return '\n'.join(final[:max_hits])
+
+def encode_reads(reads: list):
+    """Encode reads of equal length as a 2D array of symbol codes, with
+    -1 for the symbols outside the alphabet.
+
+    >>> encode_reads(['acn', 'Tga'])
+    array([[ 0,  1, -1],
+           [ 3,  2,  0]])
+    """
+    codes = np.frombuffer(encode(''.join(reads)), dtype=np.uint8).astype(np.int64)
+    codes[codes >= SIGMA] = -1
+    return codes.reshape(len(reads), -1)
+
+def _batch_rank(occ: tuple, codes, i):
+    """rank(c, i) for arrays of symbol codes and positions, with the
+    arrays of an OccTable from _batch_occ. Code -1 is ranked as 0."""
+    words, counts, dollar_words, dollar_slots = occ
+    w = i >> 5
+    below = _BELOW_ARRAY[i & 31]
+    c = np.maximum(codes, 0)
+    x = words[w] ^ _REPEAT_ARRAY[c]
+    ranks = counts[w, c] + np.bitwise_count(~(x | x >> 1) & below)
+    if len(dollar_words):
+        j = np.minimum(np.searchsorted(dollar_words, w), len(dollar_words) - 1)
+        dollar = (c == 0) & (dollar_words[j] == w)
+        ranks -= np.where(dollar, np.bitwise_count(dollar_slots[j] & below), 0)
+    return ranks
+
+def _batch_occ(O: OccTable) -> tuple:
+    dollar_words = sorted(O.dollar_slots)
+    return (np.frombuffer(O.words, dtype=np.uint64),
+            np.frombuffer(O.counts, dtype=np.uint32).astype(np.int64).reshape(-1, SIGMA),
+            np.array(dollar_words, dtype=np.int64),
+            np.array([O.dollar_slots[w] for w in dollar_words], dtype=np.uint64))
+
+def batch_backward_search(C: list, O: OccTable, n: int, codes, kmers: KmerTable = None) -> tuple:
+    """The suffix array intervals [L, R) of a block of encoded reads,
+    all advanced together one column at a time. With a KmerTable the
+    last kmers.k columns are looked up at once.
+
+    >>> sa, C, RO, O = bwt_C_O('gattacaatc')
+    >>> codes = encode_reads(['aat', 'tac', 'ttt'])
+    >>> L, R = batch_backward_search(C, O, len(sa), codes)
+    >>> [sorted(sa[i] for i in range(l, r)) for l, r in zip(L, R)]
+    [[6], [3], []]
+    >>> kmers = build_kmer_table(C, O, len(sa), 2)
+    >>> [x.tolist() for x in batch_backward_search(C, O, len(sa), codes, kmers)] == [L.tolist(), R.tolist()]
+    True
+    """
+    occ = _batch_occ(O)
+    Cs = np.array(C, dtype=np.int64)
+    L = np.zeros(len(codes), dtype=np.int64)
+    R = np.full(len(codes), n, dtype=np.int64)
+    m = codes.shape[1]
+    if kmers:
+        m -= min(kmers.k, m)
+        tail = codes[:, m:]
+        powers = np.array(kmers.power[:tail.shape[1]][::-1], dtype=np.int64)
+        i = kmers.offset[tail.shape[1]] + np.maximum(tail, 0) @ powers
+        L = np.frombuffer(kmers.L, dtype=np.uint32)[i].astype(np.int64)
+        R = np.frombuffer(kmers.R, dtype=np.uint32)[i].astype(np.int64)
+        R[(tail < 0).any(axis=1)] = 0
+        L = np.minimum(L, R)
+    for j in reversed(range(m)):
+        c = codes[:, j]
+        L = Cs[c] + _batch_rank(occ, c, L)
+        R = Cs[c] + _batch_rank(occ, c, R)
+        R[c < 0] = 0
+        L = np.minimum(L, R)
+    if STATS is not None:
+        if kmers:
+            STATS.add('kmer lookups', len(codes))
+        STATS.add('rank calls', 2 * len(codes) * m)
+        STATS.add('empty intervals', int(np.count_nonzero(L == R)))
+    return L, R
+
+def batch_D_table(C: list, RO: OccTable, n: int, codes):
+    """D_table for a block of encoded reads, one row per read. Rows
+    are not cut short at an edit limit.
+
+    >>> sa, C, RO, O = bwt_C_O('aaca')
+    >>> batch_D_table(C, RO, len(sa), encode_reads(['acca', 'aaca']))
+    array([[0, 0, 1, 1],
+           [0, 0, 0, 0]])
+    """
+    occ = _batch_occ(RO)
+    Cs = np.array(C, dtype=np.int64)
+    k, m = codes.shape
+    L = np.zeros(k, dtype=np.int64)
+    R = np.full(k, n, dtype=np.int64)
+    edits = np.zeros(k, dtype=np.int64)
+    D = np.empty((k, m), dtype=np.int64)
+    for j in range(m):
+        c = codes[:, j]
+        L = Cs[c] + _batch_rank(occ, c, L)
+        R = Cs[c] + _batch_rank(occ, c, R)
+        fail = (c < 0) | (L == R)
+        edits += fail
+        L[fail] = 0
+        R[fail] = n
+        D[:, j] = edits
+    if STATS is not None:
+        STATS.add('D table rank calls', 2 * k * m)
+    return D
+
+def batch_search(names: list, starts: array, sa: list, C: list, O: OccTable, RO: OccTable, batch: list, edit_limit: int, kmers: KmerTable = None, max_hits: int = None,
+                 masked: MaskedRuns = None) -> list:
+    """The approx_fm_search output for each (readname, read) in batch.
+
+    Reads of equal length are encoded together. Exact matching and the
+    D tables are then array operations over the whole group; only reads
+    that may match with edits go through approx_fm_search one by one.
+    The search counters are added up once per group: the arrays are
+    advanced over every column for every read, so the rank calls count
+    them all, and each read whose interval runs empty counts as one
+    empty interval.
+    """
+    n = len(sa)
+    result = [''] * len(batch)
+    groups = {}
+    for i, (readname, read) in enumerate(batch):
+        if read:
+            groups.setdefault(len(read), []).append(i)
+    for m, group in groups.items():
+        codes = encode_reads([batch[i][1] for i in group])
+        if edit_limit == 0:
+            L, R = batch_backward_search(C, O, n, codes, kmers)
+            for i, l, r in zip(group, L.tolist(), R.tolist()):
+                if l < r:
+                    readname, read = batch[i]
+                    result[i] = format_hits(names, starts, sa, [((l, r), [(f'{m}M', m)])], readname, read, max_hits, 0, masked)
+            continue
+        D = batch_D_table(C, RO, n, codes)
+        if STATS is not None:
+            STATS.add('D table rejects', int(np.count_nonzero(D[:, -1] > edit_limit)))
+        for i, row in zip(group, D.tolist()):
+            if row[-1] <= edit_limit:
+                readname, read = batch[i]
+                result[i] = approx_fm_search(names, starts, sa, C, O, read, readname, row, edit_limit, kmers, max_hits, masked)
+    return result
+
+if np is None: # the batch functions are never called, so skip their examples
+    for _batch_function in (encode_reads, batch_backward_search, batch_D_table):
+        _batch_function.__doc__ = _batch_function.__doc__.split('\n\n    >>>')[0]
+
+# The search engines map_read can use.
+ENGINES = ('backtrack', 'scheme', 'seed')
+
+def map_read(index: list, readname: str, read: str, edit_limit: int, engine: str = 'backtrack', max_hits: int = None):
+    """Yield the Simple-SAM lines for one read, one string per section,
+    and at most max_hits lines in all.
+
+    The engine is 'backtrack' for approx_fm_search, 'scheme' for
+    scheme_search or 'seed' for seed_search.
+
+    A sampled suffix array finds the same hits as the full one:
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'genome.fa')
+    >>> def hits(sa_step):
+    ...     index = load_index(process_file([('chr1', 'cgtaatgcctttccctaaca')], path, sa_step))
+    ...     return sorted(line for sam in map_read(index, 'r1', 'cccta', 2) for line in sam.splitlines())
+    >>> len(hits(1)), hits(3) == hits(1)
+    (48, True)
+
+    The engines find the same hits, also across repeats and runs of N:
+
+    >>> index = load_index(process_file([('chr1', 'acgtacgtaNNNNacgttgcaacgtacg'), ('chr2', 'ttgcaacgtnacgtac')], path))
+    >>> def engine_hits(engine, d):
+    ...     reads = ['acgtac', 'gtaacg', 'ttgcaa', 'cgtaacgt']
+    ...     return sorted(line for read in reads for sam in map_read(index, 'r1', read, d, engine) for line in sam.splitlines())
+    >>> [len(engine_hits('backtrack', d)) for d in (1, 2, 3)]
+    [33, 201, 955]
+    >>> all(engine_hits(engine, d) == engine_hits('backtrack', d) for engine in ENGINES for d in (1, 2, 3))
+    True
+    """
+    for seq in index:
+        if engine == 'scheme':
+            simplesam = scheme_search(seq['names'], seq['starts'], seq['sa'], seq['C'], seq['O'], seq['RO'], read, readname, edit_limit, max_hits, seq['masked'])
+        elif engine == 'seed':
+            simplesam = seed_search(seq['names'], seq['starts'], seq['sa'], seq['C'], seq['O'], seq['RO'], seq['text'], read, readname, edit_limit, seq['kmers'], max_hits, seq['masked'])
+        else:
+            D = D_table(seq['n'], seq['C'], seq['RO'], read, edit_limit)
+            if D == []:
+                continue
+            simplesam = approx_fm_search(seq['names'], seq['starts'], seq['sa'], seq['C'], seq['O'], read, readname, D, edit_limit, seq['kmers'], max_hits, seq['masked'])
+        if simplesam != '':
+            yield simplesam
+            if max_hits is not None:
+                max_hits -= simplesam.count('\n') + 1
+                if max_hits == 0:
+                    return
+
+# Number of reads handed to a worker process at a time.
+MAP_BATCH_SIZE = 256
+
+# The index each pool worker maps, set up once by _init_worker.
+_worker_index = None
+
+def _init_worker(prepro_file: str, stats: bool = False):
+    global _worker_index, STATS
+    # Interrupts are handled by the parent, which shuts the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_index = load_index(prepro_file)
+    STATS = Stats() if stats else None
+
+_COMPLEMENT = str.maketrans('acgtrymkbdhvnACGTRYMKBDHVN', 'tgcayrkmvhdbnTGCAYRKMVHDBN')
+
+def reverse_complement(read: str) -> str:
+    """The reverse complement of read, IUPAC codes included.
+
+    >>> reverse_complement('aacgTN'), reverse_complement('gRc')
+    ('NAcgtt', 'gYc')
+    """
+    return read.translate(_COMPLEMENT)[::-1]
+
+def first_lines(text: str, n: int = None) -> str:
+    """The first n lines of text, or all of them if n is None.
+
+    >>> first_lines('a\\nb\\nc', 2), first_lines('', 2), first_lines('a', None)
+    ('a\\nb', '', 'a')
+    """
+    return text if n is None else '\n'.join(text.split('\n')[:n])
+
+def search_reads(index: list, reads: list, edit_limit: int, engine: str = 'backtrack', max_hits: int = None) -> list:
+    """The Simple-SAM lines of each (readname, read) in reads, '' for
+    reads without hits. With NumPy installed the backtrack engine
+    searches all the reads at once with batch_search; otherwise each
+    read goes through map_read."""
+    if np is None or engine != 'backtrack':
+        return ['\n'.join(map_read(index, readname, read, edit_limit, engine, max_hits))
+                for readname, read in reads]
+    found = [batch_search(seq['names'], seq['starts'], seq['sa'], seq['C'], seq['O'], seq['RO'], reads, edit_limit, seq['kmers'], max_hits, seq['masked'])
+             for seq in index]
+    sams = ['\n'.join(sams[i] for sams in found if sams[i] != '') for i in range(len(reads))]
+    return [first_lines(sam, max_hits) for sam in sams] if len(index) > 1 else sams
+
+def map_batch(index: list, batch: list, edit_limit: int, engine: str = 'backtrack', both_strands: bool = False,
+              best: bool = False, max_hits: int = None) -> list:
+    """The Simple-SAM lines for a batch of (readname, read) pairs, one
+    string per read and '' for reads without hits; see search_reads.
+
+    With both_strands the reverse complement of every read is mapped
+    too, and each line gets a last column with the strand, + or -.
+    Lines of the minus strand hold the reverse complemented read. The
+    reverse complements join the batch, so batch_search encodes and
+    D-tables both strands in the same array passes, and reads that are
+    their own reverse complement are searched once.
+
+    With best only the hits with the fewest edits are reported. The
+    batch is searched with 0 edits, then the reads still without hits,
+    on either strand, with 1 edit, and so on up to edit_limit, so no
+    read is searched with more edits than its best hits need; the first
+    round is the exact batch_search. With max_hits at most that many
+    lines are reported per read, the plus strand first.
+
+    acgt is its own reverse complement and has hits on both strands,
+    gtaca matches the minus strand with fewer edits than the plus one,
+    and tgggt only matches the minus strand:
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'genome.fa')
+    >>> index = load_index(process_file([('chr1', 'ggacgttttgtacccaacgtgg')], path))
+    >>> batch = [('r1', 'acgt'), ('r2', 'gtaca'), ('r3', 'tgggt')]
+    >>> for sam in map_batch(index, batch, 1, both_strands=True, best=True):
+    ...     print(sam.replace('\\t', ' '))
+    r1 chr1 17 4M acgt +
+    r1 chr1 3 4M acgt +
+    r1 chr1 17 4M acgt -
+    r1 chr1 3 4M acgt -
+    r2 chr1 9 5M tgtac -
+    r3 chr1 12 5M accca -
+    >>> [sam.count('\\n') + 1 for sam in map_batch(index, batch, 1, both_strands=True)]
+    [16, 7, 4]
+    >>> for sam in map_batch(index, batch, 1, both_strands=True, max_hits=2)[1:]:
+    ...     print(sam.replace('\\t', ' '))
+    r2 chr1 10 5M gtaca +
+    r2 chr1 10 4M1I gtaca +
+    r3 chr1 12 5M accca -
+    r3 chr1 13 1I4M accca -
+    >>> map_batch(index, batch, 1, best=True)[2]
+    ''
+    """
+    if STATS is not None:
+        t0 = time.perf_counter()
+    reads = batch
+    owner = list(range(len(batch)))
+    if both_strands:
+        minus = [reverse_complement(read) for readname, read in batch]
+        distinct = [i for i, ((readname, read), rc) in enumerate(zip(batch, minus)) if rc != read]
+        reads = batch + [(batch[i][0], minus[i]) for i in distinct]
+        owner += distinct
+    if best:
+        sams = [''] * len(reads)
+        todo = range(len(reads))
+        for limit in range(edit_limit + 1):
+            found = search_reads(index, [reads[i] for i in todo], limit, engine, max_hits)
+            for i, sam in zip(todo, found):
+                sams[i] = sam
+            done = {owner[i] for i in todo if sams[i] != ''}
+            todo = [i for i in todo if owner[i] not in done]
+            if STATS is not None:
+                STATS.add('best searches', len(found))
+            if not todo:
+                break
+    else:
+        sams = search_reads(index, reads, edit_limit, engine, max_hits)
+    if both_strands:
+        rest = iter(sams[len(batch):])
+        sams = [first_lines('\n'.join(line + '\t' + strand
+                                      for strand, sam in (('+', plus), ('-', plus if rc == read else next(rest)))
+                                      if sam != '' for line in sam.split('\n')), max_hits)
+                for (readname, read), rc, plus in zip(batch, minus, sams)]
+    if STATS is not None:
+        STATS.time('map', time.perf_counter() - t0)
+    return sams
+
+def _map_batch(batch: list, options: dict) -> tuple:
+    # The worker's Stats go back to the parent with each batch.
+    sams = map_batch(_worker_index, batch, **options)
+    return sams, STATS.take() if STATS is not None else None
+
+class ReadCache:
+    """An LRU cache of the hits of mapped reads, so that a duplicate
+    read costs a lookup rather than a search.
+
+    Entries are the Simple-SAM lines of a read with the read name left
+    out, keyed by a string that names the read, the index and the
+    mapping options. Their size is estimated as the length of key and
+    lines plus ENTRY_OVERHEAD, and the least recently used entries are
+    evicted once the total goes over max_bytes. With a path, entries
+    are also kept in a dbm file there, which outlives the process and
+    is consulted on misses.
 
+    Args:
+        max_bytes (int): the memory cap.
+        path (str): the dbm file, or None for no disk tier.
+
+    >>> cache = ReadCache(2 * ReadCache.ENTRY_OVERHEAD + 10)
+    >>> cache.put('a', '1'); cache.put('b', '2'); cache.get('a'); cache.put('c', '3')
+    '1'
+    >>> cache.get('b') is None, cache.get('c')
+    (True, '3')
+    >>> cache.report()
+    'readmap: read cache: 2 hits, 1 misses, 1 evictions'
+    """
+
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, max_bytes: int, path: str = None):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        self.db = dbm.open(path, 'c') if path else None
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        """The lines stored for key, or None."""
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key: str):
+        lines = self.entries.get(key)
+        if lines is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return lines
+        if self.db is not None:
+            lines = self.db.get(key.encode())
+            if lines is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                lines = lines.decode()
+                self._store(key, lines)
+                return lines
+        self.misses += 1
+        return None
+
+    def put(self, key: str, lines: str):
+        with self.lock:
+            self._store(key, lines)
+            if self.db is not None:
+                self.db[key.encode()] = lines.encode()
+
+    def hit(self):
+        """Count a hit answered without a lookup."""
+        with self.lock:
+            self.hits += 1
+
+    def _store(self, key: str, lines: str):
+        size = len(key) + len(lines) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self.entries[key] = lines
+        self.size += size
+        while self.size > self.max_bytes:
+            key, lines = self.entries.popitem(last=False)
+            self.size -= len(key) + len(lines) + self.ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def report(self) -> str:
+        disk = f' ({self.disk_hits} from disk)' if self.db is not None else ''
+        return f'readmap: read cache: {self.hits} hits{disk}, {self.misses} misses, {self.evictions} evictions'
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+def map_reads(index: list, reads, options: dict, pool=None, workers: int = 1, cache: ReadCache = None, cache_key: str = ''):
+    """Map (name, sequence) pairs against a loaded index with the
+    map_batch options, yielding the Simple-SAM lines of each read with
+    hits, in read order. The reads are consumed lazily in batches.
+
+    With a pool whose workers were set up by _init_worker, the batches
+    are mapped there, with at most two per worker in flight. With a
+    cache, each distinct read sequence of a batch is looked up there
+    under cache_key + sequence first, and only the ones not found are
+    searched.
+    """
+    reads = iter(reads)
+    batches = iter(lambda: list(itertools.islice(reads, MAP_BATCH_SIZE)), [])
+
+    def plan(batch: list) -> tuple:
+        # The reads of batch that need a search, and the cached results.
+        if cache is None:
+            return batch, None
+        known, todo = {}, []
+        for readname, read in batch:
+            if read in known:
+                cache.hit()
+                continue
+            known[read] = cache.get(cache_key + read)
+            if known[read] is None:
+                todo.append(('', read))
+        return todo, known
+
+    def finish(batch: list, todo: list, known: dict, sams: list):
+        if known is not None:
+            for (_, read), sam in zip(todo, sams):
+                cache.put(cache_key + read, sam)
+                known[read] = sam
+            sams = ['\n'.join(readname + line for line in known[read].split('\n')) if known[read] != '' else ''
+                    for readname, read in batch]
+        if STATS is not None:
+            for sam in sams:
+                STATS.read_done(sam.count('\n') + 1 if sam != '' else 0)
+        yield from (sam for sam in sams if sam != '')
+
+    if pool is None:
+        for batch in batches:
+            todo, known = plan(batch)
+            yield from finish(batch, todo, known, map_batch(index, todo, **options))
+        return
+
+    def result(pending) -> list:
+        sams, stats = pending.get()
+        if stats is not None:
+            STATS.merge(stats)
+        return sams
+
+    pending = collections.deque()
+    for batch in batches:
+        todo, known = plan(batch)
+        pending.append((batch, todo, known, pool.apply_async(_map_batch, (todo, options))))
+        if len(pending) > 2 * workers:
+            batch, todo, known, mapped = pending.popleft()
+            yield from finish(batch, todo, known, result(mapped))
+    while pending:
+        batch, todo, known, mapped = pending.popleft()
+        yield from finish(batch, todo, known, result(mapped))
+
+def _cache_key(fingerprint: str, options: dict) -> str:
+    return (f"{fingerprint}\t{options['edit_limit']}\t{options['engine']}\t{options['both_strands']:d}\t"
+            f"{options['best']:d}\t{options['max_hits']}\t")
+
+def approximate_matching(prepro_file: str, reads, edit_limit: int, threads: int = 1, engine: str = 'backtrack', cache: ReadCache = None,
+                         both_strands: bool = False, best: bool = False, max_hits: int = None):
+    """Map every read against the index in prepro_file. The reads are
+    (name, sequence) pairs, consumed lazily, so they can be streamed.
+    See map_read for the engines, map_batch for both_strands, best and
+    max_hits, and map_reads for the cache.
+
+    With threads > 1, batches of reads are mapped by a pool of worker
+    processes that each mmap the index, so it is shared through the page
+    cache rather than copied. Results come back in read order either way.
+    """
+    if STATS is not None:
+        t0 = time.perf_counter()
+    index = load_index(prepro_file)
+    if STATS is not None:
+        STATS.time('index load', time.perf_counter() - t0)
+    options = {'edit_limit': edit_limit, 'engine': engine, 'both_strands': both_strands,
+               'best': best, 'max_hits': max_hits}
+    key = _cache_key(index_fingerprint(prepro_file), options) if cache is not None else ''
+
+    if threads <= 1:
+        yield from map_reads(index, reads, options, cache=cache, cache_key=key)
+        return
+
+    with multiprocessing.Pool(threads, _init_worker, (prepro_file, STATS is not None)) as pool:
+        yield from map_reads(index, reads, options, pool, threads, cache, key)
+
+class Stage(threading.Thread):
+    """One stage of a pipeline, run in a thread of its own.
+
+    The thread takes the items of source, whose iteration does the work
+    of the stage, and puts them in a queue of at most maxsize items;
+    the next stage takes them by iterating over the Stage. A stage with
+    a full queue waits, so it never gets more than maxsize items ahead
+    of the next one and memory stays bounded. An exception in source
+    ends the stage and is raised in the next one when it gets there.
+
+    The seconds of the stage are counted as busy, spent in source, and
+    blocked, spent waiting for room in the queue. waited counts the
+    seconds the next stage spent waiting for items; when source takes
+    its items from another Stage, that part of busy is idle time too.
+    """
+
+    _END = object()
+
+    def __init__(self, name: str, source, maxsize: int = 4):
+        super().__init__(name=f'readmap {name}', daemon=True)
+        self.source = source
+        self.queue = queue.Queue(maxsize)
+        self.busy = self.blocked = self.waited = 0.0
+        self.error = None
+
+    def run(self):
+        clock = time.perf_counter
+        try:
+            items = iter(self.source)
+            while True:
+                t0 = clock()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                t1 = clock()
+                self.queue.put(item)
+                self.busy += t1 - t0
+                self.blocked += clock() - t1
+        except BaseException as err:
+            self.error = err
+        finally:
+            self.queue.put(self._END)
+
+    def __iter__(self):
+        clock = time.perf_counter
+        while True:
+            t0 = clock()
+            item = self.queue.get()
+            self.waited += clock() - t0
+            if item is self._END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+def map_pipeline(prepro_file: str, reads, out, edit_limit: int, threads: int = 1, engine: str = 'backtrack', cache: ReadCache = None,
+                 both_strands: bool = False, best: bool = False, max_hits: int = None) -> dict:
+    """Map the (name, sequence) pairs of reads with approximate_matching
+    and write the Simple-SAM lines to out, in three stages that overlap:
+    a Stage thread parsing reads into batches, a Stage thread mapping
+    them, and the calling thread writing the hits with write_sam. Only
+    a few batches are queued between stages, however fast the others
+    are, and the calling thread stays the one that gets signals.
+
+    Returns:
+        dict: The busy seconds of each stage, 'read', 'map' and 'write',
+        and its idle seconds waiting for input and output, as
+        {stage: {'busy': s, 'input wait': s, 'output wait': s}}.
+    """
+    reads = iter(reads)
+    reader = Stage('read', iter(lambda: list(itertools.islice(reads, MAP_BATCH_SIZE)), []))
+    sams = approximate_matching(prepro_file, itertools.chain.from_iterable(reader), edit_limit, threads, engine, cache,
+                                both_strands, best, max_hits)
+    mapper = Stage('map', iter(lambda: list(itertools.islice(sams, MAP_BATCH_SIZE)), []))
+    reader.start()
+    mapper.start()
+    t0 = time.perf_counter()
+    write_sam(itertools.chain.from_iterable(mapper), out)
+    written = time.perf_counter() - t0
+    return {
+        'read': {'busy': reader.busy, 'input wait': 0.0, 'output wait': reader.blocked},
+        'map': {'busy': mapper.busy - reader.waited, 'input wait': reader.waited, 'output wait': mapper.blocked},
+        'write': {'busy': written - mapper.waited, 'input wait': mapper.waited, 'output wait': 0.0},
+    }
+
+class MapServer(socketserver.ThreadingUnixStreamServer):
+    """A server on a Unix socket that keeps an index loaded and maps
+    the reads its clients send, one thread per connection.
+
+    A request is a JSON line with the edit_limit, engine and optionally
+    both_strands, best and max_hits (see map_batch), followed by the
+    reads as FASTQ until the client shuts down its side of the
+    connection. The reply is a status line, 'OK' or 'ERROR message',
+    followed by the Simple-SAM lines, streamed as they are found. The
+    request {"stop": true} shuts the server down.
+
+    Args:
+        path (str): the socket to listen on.
+        prepro_file (str): the index.
+        pool: a pool set up by _init_worker to map in, or None to map
+            in the connection threads.
+        workers (int): the number of processes in pool.
+        cache (ReadCache): a cache shared by all clients, or None.
+    """
 
+    def __init__(self, path: str, prepro_file: str, pool=None, workers: int = 1, cache: ReadCache = None):
+        self.prepro_file = prepro_file
+        self.index = load_index(prepro_file)
+        self.fingerprint = index_fingerprint(prepro_file)
+        self.pool = pool
+        self.workers = workers
+        self.cache = cache
+        super().__init__(path, MapRequestHandler)
+
+class MapRequestHandler(socketserver.StreamRequestHandler):
+    """Serves one request to a MapServer."""
+
+    def handle(self):
+        server = self.server
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get('stop'):
+                self.wfile.write(b'OK\n')
+                threading.Thread(target=server.shutdown).start()
+                return
+            options = {'edit_limit': request['edit_limit'], 'engine': request.get('engine', 'backtrack'),
+                       'both_strands': request.get('both_strands', False), 'best': request.get('best', False),
+                       'max_hits': request.get('max_hits')}
+            if not isinstance(options['edit_limit'], int) or options['edit_limit'] < 0:
+                raise ValueError('edit_limit must be a non-negative integer')
+            if options['engine'] not in ENGINES:
+                raise ValueError(f"unknown engine {options['engine']}")
+            if not isinstance(options['both_strands'], bool):
+                raise ValueError('both_strands must be true or false')
+            if not isinstance(options['best'], bool):
+                raise ValueError('best must be true or false')
+            if options['max_hits'] is not None and (not isinstance(options['max_hits'], int) or options['max_hits'] < 1):
+                raise ValueError('max_hits must be a positive integer or null')
+        except (ValueError, KeyError, AttributeError) as err:
+            self.wfile.write(f'ERROR bad request: {err}\n'.encode())
+            return
+
+        self.wfile.write(b'OK\n')
+        reads = fastq_func(io.TextIOWrapper(self.rfile, encoding='ascii', errors='replace'))
+        key = _cache_key(server.fingerprint, options)
+        sams = map_reads(server.index, reads, options, server.pool, server.workers, server.cache, key)
+        out = io.TextIOWrapper(self.wfile, encoding='ascii')
+        try:
+            write_sam(sams, out)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client went away
+        finally:
+            out.detach()
+
+def serve(path: str, prepro_file: str, threads: int = 1, cache: ReadCache = None):
+    """Run a MapServer on path until it gets a stop request or, when
+    run in the main thread, SIGINT or SIGTERM. Requests in progress
+    are finished before it returns, and the socket file is removed.
+
+    A client gets the lines map_batch gives for its reads, and an
+    ERROR status for a bad request:
+
+    >>> import io, tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> prepro_file = process_file([('chr1', 'acgtacgtaNNNNacgttgcaacgtacg'), ('chr2', 'ttgcaacgtnacgtac')], os.path.join(folder, 'genome.fa'))
+    >>> path = os.path.join(folder, 'socket')
+    >>> server = threading.Thread(target=serve, args=(path, prepro_file))
+    >>> server.start()
+    >>> reads = [('r1', 'acgtac'), ('r2', 'ttgcaa'), ('r3', 'gggggg')]
+    >>> def remote(request):
+    ...     out = io.BytesIO()
+    ...     for attempt in range(1000): # until the server listens
+    ...         try:
+    ...             map_remote(path, request, io.StringIO(''.join(f'@{name}\\n{read}\\n' for name, read in reads)), out)
+    ...             return out.getvalue().decode().splitlines()
+    ...         except (FileNotFoundError, ConnectionRefusedError):
+    ...             time.sleep(0.01)
+    >>> local = map_batch(load_index(prepro_file), reads, 1, both_strands=True)
+    >>> remote({'edit_limit': 1, 'both_strands': True}) == [line for sam in local for line in sam.splitlines()]
+    True
+    >>> remote({'edit_limit': -1})
+    Traceback (most recent call last):
+    ...
+    ConnectionError: bad request: edit_limit must be a non-negative integer
+    >>> remote({'stop': True})
+    []
+    >>> server.join()
+    >>> os.path.exists(path)
+    False
+    """
+    if os.path.exists(path):
+        # Take over the socket of a server that is gone, but not one
+        # that is still running.
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            raise FileExistsError(f'a server is already running on {path}')
+        finally:
+            probe.close()
+
+    pool = multiprocessing.Pool(threads, _init_worker, (prepro_file,)) if threads > 1 else None
+    try:
+        server = MapServer(path, prepro_file, pool, threads, cache)
+        if threading.current_thread() is threading.main_thread(): # signals only reach the main thread
+            stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close() # waits for the connection threads
+            os.unlink(path)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def map_remote(path: str, request: dict, reads, out):
+    """Send request and the FASTQ text read from reads to the MapServer
+    on path, and copy the Simple-SAM lines it returns to the binary
+    file out. The reads are sent from a separate thread, so the server
+    never blocks on a full socket while we are still sending.
+
+    Raises:
+        ConnectionError: If the server rejects the request.
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+
+        def send():
+            try:
+                sock.sendall(json.dumps(request).encode() + b'\n')
+                if reads is not None:
+                    for chunk in iter(lambda: reads.read(1 << 16), ''):
+                        sock.sendall(chunk.encode())
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass # the server closed the connection; its status says why
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        with sock.makefile('rb') as reply:
+            status = reply.readline().decode().strip()
+            if status != 'OK':
+                raise ConnectionError(status.removeprefix('ERROR ') or 'no reply from the server')
+            for chunk in iter(lambda: reply.read(1 << 16), b''):
+                out.write(chunk)
+        out.flush()
+        sender.join()
 
 def main():
+    global STATS
     argparser = argparse.ArgumentParser(
         description="Readmapper",
-        usage="\n\treadmap -p genome\n\treadmap -d dist genome reads"
+        usage="\n\treadmap -p [--update] [-s step] [-k length] [-t threads] [--shard-size bp] [--index-dir dir] genome\n\treadmap -d dist [-t threads] [--engine engine] [--both-strands] [--best] [--max-hits N] [--cache-size MB] [--cache-file file] [--index-dir dir] [-o file] genome reads"
+              "\n\treadmap --serve socket [-t threads] [--cache-size MB] [--cache-file file] [--index-dir dir] genome"
+              "\n\treadmap --client socket [-d dist] [--engine engine] [--both-strands] [--best] [--max-hits N] [-o file] [reads]"
+              "\n\treadmap --client socket --stop"
     )
     argparser.add_argument(
         "-p", action="store_true",
         help="preprocess the genome."
     )
+    argparser.add_argument(
+        "--update", action="store_true",
+        help="with -p, index only the sequences added or changed since an earlier index of the genome "
+             "with the same name and index options, and keep the rest of it."
+    )
     argparser.add_argument(
         "-d", type=int, metavar="integer",
         default=1, help="max edit distance."
     )
     argparser.add_argument(
-        "genome",
-        help="Simple-FASTA file containing the genome.",
-        type=argparse.FileType('r')
+        "-s", type=int, metavar="integer",
+        help="suffix array sampling rate of the index (default: 1, keep all)."
+    )
+    argparser.add_argument(
+        "-k", type=int, metavar="integer",
+        help="longest string in the k-mer interval table of the index "
+             "(default: chosen from the genome size, 0 for no table)."
+    )
+    argparser.add_argument(
+        "-t", "--threads", type=int, metavar="integer",
+        default=1, help="number of worker processes used for mapping or preprocessing."
+    )
+    argparser.add_argument(
+        "--shard-size", type=int, metavar="bp",
+        help=f"sequences are indexed in shards of about this size (default: {SHARD_SIZE})."
+    )
+    argparser.add_argument(
+        "--index-dir", metavar="dir",
+        help=f"keep indexes in this directory (default: ${INDEX_DIR_ENV}, or else the genome's directory). "
+             "Indexes are named by a hash of the genome and the index options above, and mapping builds "
+             "the index if it is missing; without index options it uses any index of the genome."
+    )
+    argparser.add_argument(
+        "--engine", choices=ENGINES,
+        default="backtrack", help="backtracking search, bidirectional search schemes or seed-and-extend."
+    )
+    argparser.add_argument(
+        "--both-strands", action="store_true",
+        help="also map the reverse complement of each read; hits get a last column with the strand, + or -."
+    )
+    argparser.add_argument(
+        "--best", action="store_true",
+        help="report only the hits of each read with the fewest edits."
+    )
+    argparser.add_argument(
+        "--max-hits", type=int, metavar="N",
+        help="report at most N hits per read, those with fewer edits first for the backtrack engine (default: all)."
+    )
+    argparser.add_argument(
+        "--cache-size", type=int, metavar="MB",
+        default=64, help="memory for cached results of duplicate reads (default: 64, 0 for no cache)."
+    )
+    argparser.add_argument(
+        "--cache-file", metavar="file",
+        help="keep cached results in this dbm file across runs."
+    )
+    argparser.add_argument(
+        "-o", "--output", metavar="file",
+        help="write the Simple-SAM output here, compressed in parallel if it ends in .gz (default: standard output)."
+    )
+    argparser.add_argument(
+        "--stats", action="store_true",
+        help="write a JSON summary of the search work and time per phase to stderr; "
+             "the scheme and seed engines report no search counters."
+    )
+    argparser.add_argument(
+        "--serve", metavar="socket",
+        help="keep the index of genome loaded and map reads sent to this Unix socket."
+    )
+    argparser.add_argument(
+        "--client", metavar="socket",
+        help="map reads (default: standard input) with the server on this Unix socket."
+    )
+    argparser.add_argument(
+        "--stop", action="store_true",
+        help="with --client, shut the server down."
+    )
+    argparser.add_argument(
+        "genome", nargs="?",
+        help="Simple-FASTA file containing the genome, optionally gzip-compressed."
     )
     argparser.add_argument(
         "reads", nargs="?",
-        help="Simple-FASTQ file containing the reads.",
-        type=argparse.FileType('r')
+        help="Simple-FASTQ file containing the reads, optionally gzip-compressed ('-' for standard input)."
     )
     args = argparser.parse_args()
 
+    def open_input(path: str):
+        try:
+            return open_text(path)
+        except OSError as err:
+            argparser.error(f"can't open '{path}': {err.strerror}")
+
+    def create_output():
+        try:
+            return open_output(args.output, args.threads)
+        except OSError as err:
+            argparser.error(f"can't open '{args.output}': {err.strerror}")
+
+    if args.d < 0:
+        argparser.error("the edit distance -d cannot be negative")
+    if args.s is not None and args.s < 1:
+        argparser.error("the sampling rate -s must be at least 1")
+    if args.k is not None and args.k < 0:
+        argparser.error("the k-mer length -k cannot be negative")
+    if args.k is not None and args.k > MAX_KMER_LENGTH:
+        argparser.error(f"the k-mer length -k can be at most {MAX_KMER_LENGTH}")
+    if args.threads < 1:
+        argparser.error("the number of threads must be at least 1")
+    if args.shard_size is not None and args.shard_size < 1:
+        argparser.error("the shard size must be at least 1")
+    if args.cache_size < 0:
+        argparser.error("the cache size cannot be negative")
+    if args.update and not args.p:
+        argparser.error("--update only applies to -p")
+    if args.output and (args.p or args.serve or args.stop):
+        argparser.error("-o only applies to mapping")
+    if args.both_strands and (args.p or args.serve or args.stop):
+        argparser.error("--both-strands only applies to mapping")
+    if args.best and (args.p or args.serve or args.stop):
+        argparser.error("--best only applies to mapping")
+    if args.max_hits is not None and (args.p or args.serve or args.stop):
+        argparser.error("--max-hits only applies to mapping")
+    if args.max_hits is not None and args.max_hits < 1:
+        argparser.error("--max-hits must be at least 1")
+
+    if args.client:
+        # Only the reads are given, in the genome's place.
+        if args.reads is not None:
+            argparser.error("--client takes only the reads")
+        request = {'stop': True} if args.stop else {'edit_limit': args.d, 'engine': args.engine, 'both_strands': args.both_strands,
+                                                       'best': args.best, 'max_hits': args.max_hits}
+        reads = None if args.stop else open_input(args.genome or '-')
+        out = create_output()
+        try:
+            map_remote(args.client, request, reads, out.buffer)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.exit(f"readmap: no server on {args.client}")
+        except ConnectionError as err:
+            sys.exit(f"readmap: {err}")
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
+    if args.genome is None:
+        argparser.error("the genome is required")
+    if args.genome == '-':
+        argparser.error("the genome must be a file")
+
+    def find_index(exact: bool) -> str:
+        try:
+            return ensure_index(args.genome, 1 if args.s is None else args.s, args.k,
+                                SHARD_SIZE if args.shard_size is None else args.shard_size,
+                                args.index_dir, args.threads, sys.stderr, exact, args.update)
+        except (EOFError, zlib.error) as err:
+            sys.exit(f"readmap: {args.genome}: {err}")
+        except OSError as err:
+            sys.exit(f"readmap: can't open '{err.filename}': {err.strerror}")
+    # Mapping takes any index of the genome unless index options are given.
+    index_options = args.s is not None or args.k is not None or args.shard_size is not None
+
+    cache = None
+    if not args.p and (args.cache_size > 0 or args.cache_file):
+        cache = ReadCache(args.cache_size << 20, args.cache_file)
+
     if args.p:
         print(f"Preprocess {args.genome}")
-        fasta_dict = fasta_func(args.genome)
-
-        process_file(fasta_dict, args.genome.name)
+        print(f"Index {find_index(True)}")
+    elif args.serve:
+        prepro_file = find_index(index_options)
+        try:
+            serve(args.serve, prepro_file, args.threads, cache)
+        except (IndexFormatError, FileExistsError) as err:
+            sys.exit(f"readmap: {err}")
+        finally:
+            if cache is not None:
+                print(cache.report(), file=sys.stderr)
+                cache.close()
     else:
         # here we need the optional argument reads
         if args.reads is None:
             argparser.print_help()
             sys.exit(1)
         
-        prepro_file = args.genome.name.split('.')[0]+'_prepro.txt'
-        
-        fastq_dict = fastq_func(args.reads)
-        sams = approximate_matching(prepro_file, fastq_dict, args.d)
-        for s in sams:
-            print(s)
+        prepro_file = find_index(index_options)
+
+        if args.stats:
+            STATS = Stats()
+        t0 = time.perf_counter()
+
+        reads = open_input(args.reads)
+        out = create_output()
+        parsed = fastq_func(reads)
+        if STATS is not None:
+            parsed = STATS.timed('parse', parsed)
+        try:
+            stages = map_pipeline(prepro_file, parsed, out, args.d, args.threads, args.engine, cache,
+                                  args.both_strands, args.best, args.max_hits)
+            if out is not sys.stdout:
+                out.close() # compresses the last blocks
+            if STATS is not None:
+                STATS.time('write', time.perf_counter() - t0)
+                STATS.time('wait', stages['write']['input wait'])
+                for stage, seconds in stages.items():
+                    for kind, t in seconds.items():
+                        STATS.time(f'{stage} {kind}', t)
+                STATS.time('total', time.perf_counter() - t0)
+                print(json.dumps(STATS.summary(), indent=2), file=sys.stderr)
+        except IndexFormatError as err:
+            sys.exit(f"readmap: {err}")
+        except (EOFError, zlib.error) as err:
+            sys.exit(f"readmap: {args.reads}: {err}")
+        finally:
+            reads.close()
+            if out is not sys.stdout:
+                out.close()
+            if cache is not None:
+                print(cache.report(), file=sys.stderr)
+                cache.close()
 
 
 if __name__ == '__main__':